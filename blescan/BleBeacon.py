@@ -69,14 +69,18 @@ class BleBeacon:
         """ detect devices that are detected more often or equal to the threshold amount"""
         self.matches = [dev for dev, count in accumulation.items() if count >= self.threshold]
 
-    def update_time_rssi(self):
+    def update_time_rssi(self) -> List[str]:
+        """update staying time and rssi of present beacons. Return the macs of beacons that just entered"""
+        entered = []
         for mac in self.matches:
             device = self.macs[mac]
             if mac not in self.rssi_list.keys():
                 self.detected_time[mac] = datetime.now()
                 self.rssi_list[mac] = [device.get_rssi()]
+                entered.append(mac)
             else:
                 self.rssi_list[mac].append(device.get_rssi())
+        return entered
 
     def update(self, scanned_devices):
         """update the list of devices. Will add devices to the current timestep and then increase the timestep by one"""
@@ -105,7 +109,10 @@ class BleBeacon:
         acc = self.accumulate()
 
         self.detect_matches(acc)
-        self.update_time_rssi()
+        entered = self.update_time_rssi()
+
+        if len(entered) > 0:
+            self.store_entered(entered)
 
         exited = [mac for mac in self.rssi_list.keys() if mac not in self.matches]
 
@@ -144,15 +151,29 @@ class BleBeacon:
             except Exception as e:
                 logger.error(f"Unkwnow writing error: {e}")
 
+    def store_entered(self, macs):
+        """notify all given storage instances about beacons that just became present"""
+        logger.debug(f"beacons entered: {len(macs)}")
+
+        time = datetime.now()
+        id = config.Config.serial_number
+
+        for mac in macs:
+            for storage in self.storages:
+                try:
+                    manufacturer_data = self.macs[mac].get_manufacturer_data()
+                    storage.save_beacon_enter(id, time, self.rssi_list[mac][0], manufacturer_data)
+                except PermissionError as e:
+                    logger.debug(f"No writing permission for {storage}")
+                except Exception as e:
+                    logger.debug(f"Unkwnow writing error: {e}")
+
     def store_devices(self, macs):
         """store results into all given storage instances"""
         logger.debug("storing beacon data")
         logger.info(f"beacons to store: {len(self.matches)}")
 
-        # format for storing:
         time = datetime.now()
-        timestr = time.strftime("%H:%M:%S")
-
         id = config.Config.serial_number
 
         for mac in macs:
@@ -160,7 +181,7 @@ class BleBeacon:
                 try:
                     staying_time = round((datetime.now() - self.detected_time[mac]).total_seconds())
                     manufacturer_data = self.macs[mac].get_manufacturer_data()
-                    storage.save_beacon_stay(id, timestr, staying_time, self.rssi_list[mac], manufacturer_data)
+                    storage.save_beacon_stay(id, time, staying_time, self.rssi_list[mac], manufacturer_data)
                 except PermissionError as e:
                     logger.debug(f"No writing permission for {storage}")
                 except Exception as e:
@@ -2,6 +2,8 @@ from typing import List, Union
 from device import Device
 from datetime import datetime, timedelta
 from collections import Counter
+from hashlib import blake2b
+import secrets
 from storage import Storage
 from config import Config
 import logging
@@ -48,7 +50,13 @@ class BleCount:
             "total_time": 0
         }
         self.static_list = []
-        self.close_ble_list = []
+        # close devices of the current transit window: code -> [first_seen, last_seen, best_rssi]
+        self.close_ble_seen = {}
+        # anonymized codes of the current transit window, memoized per mac
+        self.transit_codes = {}
+        self.transit_key_date = None
+        self.transit_key = b''
+        self.transit_salt = b''
         self.instantaneous_counts = {
             "all": [],
             "close": []
@@ -97,31 +105,66 @@ class BleCount:
         self.prev_remainder['count'] = seconds % Config.Counting.delta
 
         # prepare list for transit time detection
-        for device in close:
-            code = self.encript_mac_to_code(device.get_mac())
-            self.close_ble_list.append(code)
+        self.update_transit_key(now)
+        self.accumulate_close(close, now.timestamp())
 
         if seconds % Config.Transit.delta < self.prev_remainder['transit']:
             reference_time = midnight + timedelta(seconds=(seconds // Config.Transit.delta) * Config.Transit.delta)
-            self.close_ble_list = list(set(self.close_ble_list))
             logger.debug(f"transit data for {reference_time} ready to be sent to the backend")
             self.store_transit(reference_time)
+            self.transit_codes.clear()
         self.prev_remainder['transit'] = seconds % Config.Transit.delta
 
+    def accumulate_close(self, close: List[Device], timestamp: float):
+        """keep first and last time seen and the best rssi for every close device of the transit window"""
+        for device in close:
+            code = self.anonymize_mac(device.get_mac())
+            rssi = device.get_rssi()
+            seen = self.close_ble_seen.get(code)
+            if seen is None:
+                self.close_ble_seen[code] = [timestamp, timestamp, rssi]
+            else:
+                seen[1] = timestamp
+                if rssi > seen[2]:
+                    seen[2] = rssi
+
     def __str__(self) -> str:
         return self.name
 
-    def encript_mac_to_code(self, mac_address: str) -> int:
-        string, mac_address = '', mac_address.replace(":", "")
-        for i in range(len(mac_address)):
-            num = ord(mac_address[i])
-            code = num
-            if 48 <= num <= 57:
-                code = num - 48
-            elif 97 <= num <= 109:
-                code = num - 87
-            string = string + str(code)
-        return int(string)
+    def update_transit_key(self, now: datetime):
+        """
+        Set key and salt for anonymizing mac addresses. The salt is the current date, so codes change every day.
+        The key is the configured secret, shared by all devices of an event. Without one, a random key is used,
+        so the codes can not be computed by anyone else, but they can not be matched between devices (or restarts) either.
+        """
+        date = now.strftime('%Y%m%d')
+        if date == self.transit_key_date:
+            return
+
+        key = Config.Transit.key.encode()
+        if not key:
+            if self.transit_key_date is None:
+                logger.warn("No transit key configured. Using a random key, transit ids can not be matched between devices")
+            key = secrets.token_bytes(blake2b.MAX_KEY_SIZE)
+        if len(key) > blake2b.MAX_KEY_SIZE:
+            key = blake2b(key).digest()
+
+        self.transit_key = key
+        self.transit_salt = date.encode()
+        self.transit_key_date = date
+        self.transit_codes.clear()
+
+    def anonymize_mac(self, mac_address: str) -> int:
+        """
+        Map a mac address to a signed 64 bit code using a keyed and salted hash.
+        The result is memoized until the transit window is stored.
+        """
+        code = self.transit_codes.get(mac_address)
+        if code is None:
+            digest = blake2b(mac_address.encode(), digest_size=8, key=self.transit_key, salt=self.transit_salt).digest()
+            code = int.from_bytes(digest, 'big', signed=True)
+            self.transit_codes[mac_address] = code
+        return code
 
     def get_rssi_list(self) -> List[int]:
         return [dev.get_rssi() for dev in self.scanned_devices.values()]
@@ -170,9 +213,23 @@ class BleCount:
 
         id = Config.serial_number
         timestamp = time.isoformat()
-        close_ble_list = self.close_ble_list
 
-        for storage in self.storages:
-            storage.save_transit(id, timestamp, close_ble_list)
+        # immutable snapshot, sorted once and shared by all storages.
+        # storages may keep a reference (e.g. in a queue), so it must never be modified afterwards
+        close_ble_list = tuple(sorted(self.close_ble_seen.keys()))
+
+        # only pass the detailed information if it is needed
+        seen = None
+        if Config.Transit.send_timestamps:
+            seen = {code: tuple(values) for code, values in self.close_ble_seen.items()}
 
-        self.close_ble_list.clear()
\ No newline at end of file
+        # start a new window, the snapshot above is independent of it
+        self.close_ble_seen = {}
+
+        for storage in self.storages:
+            try:
+                storage.save_transit(id, timestamp, close_ble_list, seen)
+            except PermissionError as e:
+                logger.error(f"No writing permission for {storage}")
+            except Exception as e:
+                logger.error(f"Unkwnow writing error: {e}")
\ No newline at end of file
@@ -26,6 +26,21 @@ class Config:
         use_internet: bool = False
         internet_url: str = None
 
+    class Internet:
+        batch_size: int = 1
+        batch_linger: float = 0
+        backoff_base: float = 2
+        backoff_max: float = 300
+        breaker_threshold: int = 3
+        spool_dir: str = 'spool'
+        spool_max_messages: int = 50000
+        spool_max_mb: float = 50
+        newest_first: bool = True
+        backfill_interval: float = 1
+        compact: bool = False
+        shutdown_timeout: float = 5
+        max_in_flight: int = 1
+
     class XBee:
         use_xbee: bool = False
         internet_ids: List[str] = []
@@ -36,6 +51,10 @@ class Config:
         baud_rate: int = 9600
         is_coordinator: bool = True
         my_label: str = " "
+        load_balance: bool = True
+        shutdown_timeout: float = 5
+        forward_beacon: bool = False
+        forward_transit: bool = False
 
     class Beacon:
         target_id: str = ''
@@ -44,12 +63,16 @@ class Config:
         storage: List = []
         shutdown_on_scan: bool = False
         shutdown_id: str = None
+        use_internet: bool = False
+        internet_url: str = None
 
     class Transit:
         delta: int = 5
         storage: List = []
         use_internet: bool = False
         internet_url: str = None
+        key: str = ''
+        send_timestamps: bool = False
 
     @staticmethod
     def check_integrity():
@@ -64,11 +87,15 @@ class Config:
         
         if Config.Transit.use_internet and Config.Transit.internet_url == None:
             raise ValueError(f"Using internet for transit without defining url!")
+
+        if Config.Beacon.use_internet and Config.Beacon.internet_url == None:
+            raise ValueError(f"Using internet for beacons without defining url!")
         
         if Config.XBee.use_xbee and not Config.XBee.internet_ids:
             raise ValueError("Using XBee, but no internet nodes set")
         
-        if not Config.Counting.storage and not Config.Beacon.storage and not Config.Counting.use_internet and not Config.Transit.use_internet:
+        if not Config.Counting.storage and not Config.Beacon.storage and not Config.Counting.use_internet and not Config.Transit.use_internet \
+                and not Config.Beacon.use_internet and not Config.XBee.forward_beacon and not Config.XBee.forward_transit:
             raise ValueError("Not storing any counting, beacon or transit data!")
 
 def _get_storage_paths(inifile, section, key):
@@ -102,6 +129,8 @@ def _parse_transit_settings(inifile):
     Config.Transit.storage += _get_storage_paths(inifile, section, 'storage')
     Config.Transit.use_internet = bool(int(section.get('internet_for_transit', '0')))
     Config.Transit.internet_url = section.get('url', None)
+    Config.Transit.key = section.get('key', '')
+    Config.Transit.send_timestamps = bool(int(section.get('send_timestamps', '0')))
 
 def _parse_counting_settings(inifile):
     logger.debug("parsing counting config")
@@ -118,6 +147,25 @@ def _parse_counting_settings(inifile):
     Config.Counting.internet_url = section.get('url', None)
     
 
+def _parse_internet_settings(inifile):
+    logger.debug("parsing internet config")
+    if not inifile.has_section('INTERNET'):
+        return
+    section = inifile['INTERNET']
+    Config.Internet.batch_size = int(section.get('batch_size', 1))
+    Config.Internet.batch_linger = float(section.get('batch_linger', 0))
+    Config.Internet.backoff_base = float(section.get('backoff_base', 2))
+    Config.Internet.backoff_max = float(section.get('backoff_max', 300))
+    Config.Internet.breaker_threshold = int(section.get('breaker_threshold', 3))
+    Config.Internet.spool_dir = section.get('spool_dir', 'spool')
+    Config.Internet.spool_max_messages = int(section.get('spool_max_messages', 50000))
+    Config.Internet.spool_max_mb = float(section.get('spool_max_mb', 50))
+    Config.Internet.newest_first = bool(int(section.get('newest_first', '1')))
+    Config.Internet.backfill_interval = float(section.get('backfill_interval', 1))
+    Config.Internet.compact = bool(int(section.get('compact', '0')))
+    Config.Internet.shutdown_timeout = float(section.get('shutdown_timeout', 5))
+    Config.Internet.max_in_flight = int(section.get('max_in_flight', 1))
+
 def _parse_xbee_settings(inifile):
     section = inifile["ZIGBEE"]
     Config.XBee.use_xbee = bool(int(section.get('use_zigbee', '0')))
@@ -133,6 +181,10 @@ def _parse_xbee_settings(inifile):
 
     nodes = section.get('internet_nodes')
     Config.XBee.internet_ids = [_.strip() for _ in nodes.split(',')]
+    Config.XBee.load_balance = bool(int(section.get('load_balance', '1')))
+    Config.XBee.shutdown_timeout = float(section.get('shutdown_timeout', 5))
+    Config.XBee.forward_beacon = bool(int(section.get('forward_beacon', '0')))
+    Config.XBee.forward_transit = bool(int(section.get('forward_transit', '0')))
 
 
 def _parse_beacon_settings(inifile):
@@ -147,6 +199,9 @@ def _parse_beacon_settings(inifile):
     if Config.Beacon.shutdown_id:
         Config.Beacon.shutdown_on_scan = True
 
+    Config.Beacon.use_internet = bool(int(section.get('internet_for_beacon', '0')))
+    Config.Beacon.internet_url = section.get('url', None)
+
 def _parse_user_settings(inifile):
     logger.debug("parsing user config")
     section = inifile['USER']
@@ -174,6 +229,7 @@ def parse_ini(path='config.ini'):
 
     _parse_user_settings(inifile)
     _parse_counting_settings(inifile)
+    _parse_internet_settings(inifile)
     _parse_xbee_settings(inifile)
     _parse_beacon_settings(inifile)
     _parse_transit_settings(inifile)
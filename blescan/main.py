@@ -25,11 +25,14 @@ from storage import Storage
 from led import LEDCommunicator, LEDState
 from config import Config, parse_ini
 from network import InternetStorage, InternetController
-from xbee import decode_data, XBeeStorage, XBeeController
+from uplink import AsyncInternetController
+from relay import XBeeRelay
+from xbee import XBeeStorage, XBeeController
 
 led_communicator = LEDCommunicator()
 internet = InternetController(led_communicator=led_communicator)
 xbee = XBeeController(led_communicator=led_communicator)
+relay: XBeeRelay = None
 
 
 CODE_SHUTDOWN_DEVICE = 100
@@ -42,7 +45,7 @@ def main(config_path: str='./config.ini'):
     if Config.led:
         led_communicator.start()
 
-    if Config.Counting.use_internet or Config.Transit.use_internet:
+    if Config.Counting.use_internet or Config.Transit.use_internet or Config.Beacon.use_internet:
         setup_internet()
 
     if Config.XBee.use_xbee:
@@ -170,38 +173,50 @@ def file_exists(file_path):
 
 def shutdown_blescan():
     logger.info("--- stopping daemons ---")
-    internet.stop()
     xbee.stop()
+    # forward what the coordinator received before the internet process stops
+    if relay is not None:
+        relay.stop()
+    internet.stop()
     
     if Config.led:
         led_communicator.stop()
 
 def setup_internet():
+    global internet
     logger.debug("Setting up internet")
 
+    if Config.Internet.max_in_flight > 1:
+        internet = AsyncInternetController(led_communicator=led_communicator)
+
     internet.set_count_url(Config.Counting.internet_url)
     internet.set_transit_url(Config.Transit.internet_url)
+    internet.set_beacon_url(Config.Beacon.internet_url)
 
     up = InternetStorage(internet)
     Config.Counting.storage.append(up)
+    if Config.Beacon.use_internet:
+        Config.Beacon.storage.append(up)
 
     internet.start()
 
-def receive_xbee_message(sender, text):
-    decoded = decode_data(text)
-    logger.debug(f"received message from xbee {sender}, decoded: {decoded}")
-    internet.enqueue_message(decoded)
-
-
 def setup_xbee():
+    global relay
     logger.info("Setting up xbee")
-    xbee.set_message_received_callback(receive_xbee_message)
+
+    if Config.XBee.my_label in Config.XBee.internet_ids:
+        # the xbee callback runs in the xbee process, the relay forwards the messages to the internet process
+        relay = XBeeRelay(internet)
+        relay.start()
+        xbee.set_message_received_callback(relay.receive)
     xbee.start()
     
     if xbee.is_sender:
         logger.debug("appending xbee storage")
         stor = XBeeStorage(xbee)
         Config.Counting.storage.append(stor)
+        if Config.XBee.forward_beacon:
+            Config.Beacon.storage.append(stor)
     else:
         logger.debug("setting message callback")
 
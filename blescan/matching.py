@@ -0,0 +1,189 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+import csv
+import heapq
+import logging
+import os
+import re
+import sys
+
+logger = logging.getLogger('blescan.Matching')
+
+MATCHING_HORIZON = 600
+MATCHING_BIN_SIZE = 10
+
+# records are (time as epoch seconds, node id, close codes)
+TransitRecord = Tuple[float, int, List[int]]
+
+class TravelTimeDistribution:
+    """
+    Streaming histogram of travel times between two nodes.
+    Values are kept in bins of `bin_size` seconds, so memory only depends on the horizon.
+    """
+
+    def __init__(self, bin_size: int = MATCHING_BIN_SIZE):
+        self.bin_size = bin_size
+        self.bins: Dict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, travel_time: float):
+        self.bins[int(travel_time // self.bin_size)] += 1
+        self.count += 1
+        self.total += travel_time
+        self.minimum = travel_time if self.minimum is None else min(self.minimum, travel_time)
+        self.maximum = travel_time if self.maximum is None else max(self.maximum, travel_time)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q: float) -> float:
+        """approximate quantile (center of the bin containing it)"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index in sorted(self.bins.keys()):
+            seen += self.bins[index]
+            if seen >= target:
+                return (index + 0.5) * self.bin_size
+        return self.maximum
+
+    def histogram(self) -> Dict[int, int]:
+        """lower bin boundary in seconds -> amount of matches"""
+        return {index * self.bin_size: self.bins[index] for index in sorted(self.bins.keys())}
+
+    def __str__(self):
+        return f"n={self.count} mean={self.mean()} median={self.quantile(0.5)} min={self.minimum} max={self.maximum}"
+
+
+class TransitMatcher:
+    """
+    Matches the anonymized close codes of several nodes to compute travel times between them.
+
+    Records have to be added in (roughly) chronological order, as done by `add_record` while running
+    (e.g. by `XBeeRelay` for the transit windows relayed by a coordinator) or `ingest` when reading files.
+    When a code shows up at a node, it is joined with the last time the same code was seen at the other nodes
+    within `horizon` seconds. The difference is the travel time from the other node to this node.
+    Codes not seen for longer than the horizon are dropped, so memory stays bounded.
+    """
+
+    def __init__(self, horizon: int = MATCHING_HORIZON, bin_size: int = MATCHING_BIN_SIZE,
+                 on_match: Callable[[int, int, float], None] = None):
+        """
+        Keyword arguments:
+        horizon -- maximum travel time (and time without detection until a device is considered gone) in seconds
+
+        bin_size -- resolution of the travel time distributions in seconds
+
+        on_match -- optional callback (from_node, to_node, travel_time) for every match
+        """
+        self.horizon = horizon
+        self.bin_size = bin_size
+        self.on_match = on_match
+        # code -> {node: [first_seen, last_seen]}
+        self.sightings: Dict[int, Dict[int, List[float]]] = {}
+        self.distributions: Dict[Tuple[int, int], TravelTimeDistribution] = {}
+        self.last_purge = None
+
+    def add_record(self, node: int, time: float, codes: Iterable[int]):
+        """add the close codes of one transit window of a node"""
+        if self.last_purge is None:
+            self.last_purge = time
+        elif time - self.last_purge > self.horizon:
+            self.purge(time)
+
+        for code in codes:
+            nodes = self.sightings.get(code)
+            if nodes is None:
+                self.sightings[code] = {node: [time, time]}
+                continue
+
+            seen = nodes.get(node)
+            if (seen is not None and time - seen[1] <= self.horizon
+                    and not any(last > seen[1] for other, (_, last) in nodes.items() if other != node)):
+                # still the same stay at this node (not seen anywhere else in between)
+                seen[1] = max(seen[1], time)
+                continue
+
+            for other, (first, last) in nodes.items():
+                if other != node and 0 <= time - last <= self.horizon:
+                    self._add_match(other, node, time - last)
+            nodes[node] = [time, time]
+
+    def _add_match(self, from_node: int, to_node: int, travel_time: float):
+        distribution = self.distributions.get((from_node, to_node))
+        if distribution is None:
+            distribution = TravelTimeDistribution(self.bin_size)
+            self.distributions[(from_node, to_node)] = distribution
+        distribution.add(travel_time)
+
+        if self.on_match is not None:
+            self.on_match(from_node, to_node, travel_time)
+
+    def purge(self, now: float):
+        """drop all sightings older than the horizon"""
+        limit = now - self.horizon
+        expired = [code for code, nodes in self.sightings.items() if all(last < limit for _, last in nodes.values())]
+        for code in expired:
+            del self.sightings[code]
+        self.last_purge = now
+        logger.debug(f"purged {len(expired)} codes, {len(self.sightings)} remaining")
+
+    def ingest(self, records: Iterable[TransitRecord]):
+        for time, node, codes in records:
+            self.add_record(node, time, codes)
+
+    def get_distribution(self, from_node: int, to_node: int) -> TravelTimeDistribution:
+        return self.distributions.get((from_node, to_node), None)
+
+
+def _date_from_path(path: str) -> datetime:
+    """transit files contain the date in the file or folder name, e.g. ACC01_20240101_transit.csv"""
+    match = re.search(r'_(\d{8})', path)
+    if match is None:
+        raise ValueError(f"Cannot find date in transit file name {path}")
+    return datetime.strptime(match.group(1), '%Y%m%d')
+
+def read_transit_file(path: str) -> Iterator[TransitRecord]:
+    """read records of a _transit.csv file as written by `Storage.save_transit`"""
+    date = _date_from_path(path)
+    with open(path, 'r') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0] == 'ID':
+                continue
+            time = datetime.combine(date.date(), datetime.strptime(row[1], '%H:%M:%S').time())
+            codes = [int(code) for code in row[2].strip('"').split(',') if code]
+            yield time.timestamp(), int(row[0]), codes
+
+def read_transit_files(paths: List[str]) -> Iterator[TransitRecord]:
+    """read several transit files (usually one per node) merged in chronological order"""
+    return heapq.merge(*[read_transit_file(path) for path in paths], key=lambda record: record[0])
+
+def find_transit_files(base_dir: str) -> List[str]:
+    found = []
+    for root, _, files in os.walk(base_dir):
+        found.extend(os.path.join(root, name) for name in files if name.endswith('_transit.csv'))
+    return sorted(found)
+
+
+if __name__ == "__main__":
+    # usage: python matching.py <transit files or folders> [horizon]
+    paths = []
+    horizon = MATCHING_HORIZON
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths.extend(find_transit_files(arg))
+        elif arg.isdigit():
+            horizon = int(arg)
+        else:
+            paths.append(arg)
+
+    matcher = TransitMatcher(horizon)
+    matcher.ingest(read_transit_files(paths))
+
+    for (from_node, to_node), distribution in sorted(matcher.distributions.items()):
+        print(f"{from_node} -> {to_node}: {distribution}")
@@ -1,12 +1,21 @@
-from storage import prepare_row_data_summary
+from storage import prepare_row_data_summary, prepare_beacon_event, BEACON_EVENT_ENTER, BEACON_EVENT_EXIT
 from datetime import datetime
-from typing import List, Dict, Union
+from statistics import mean
+from typing import Any, Callable, List, Dict, Tuple, Union
 from config import Config
 from led import LEDState, LEDCommunicator
-from time import sleep
+from spool import UploadSpool, SPOOL_MEMORY
+from time import monotonic
+from queue import Empty
+import base64
+import gzip
+import json
 import logging
 import multiprocessing as mp
+import os
+import random
 import requests
+import threading
 import util
 
 logger = logging.getLogger('blescan.Network')
@@ -16,6 +25,431 @@ DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 INTERNET_STACKING_THRESHOLD = 3
 INTERNET_QUEUE_SIZE_COUNT = 1000
 INTERNET_QUEUE_SIZE_TRANSIT = 100
+INTERNET_QUEUE_SIZE_BEACON = 1000
+INTERNET_BEACON_BATCH_SIZE = 50
+
+# connections kept open per host
+INTERNET_POOL_SIZE = 2
+INTERNET_REQUEST_TIMEOUT = 5
+# time the internet process gets to finish after the shutdown timeout, before it is terminated
+INTERNET_SHUTDOWN_GRACE = INTERNET_REQUEST_TIMEOUT + 1
+# seconds between two log entries with the metrics of the endpoints
+INTERNET_METRICS_INTERVAL = 300
+
+# compact payload format (see `CompactEncoder`)
+COMPACT_FORMAT = 'compact-1'
+COMPACT_DROPPED_FIELDS = ('date', 'time')
+COMPACT_STATIC_FIELDS = ('rssi_thresh', 'static_ratio', 'latitude', 'longitude')
+# static fields are sent again after this time, in case the backend lost them
+COMPACT_STATIC_INTERVAL = 3600
+# responses of backends that do not support the compact format
+COMPACT_REJECTED_STATUS = (400, 415)
+
+INTERNET_QUEUE_SIZES = {'count': INTERNET_QUEUE_SIZE_COUNT,
+                        'transit': INTERNET_QUEUE_SIZE_TRANSIT,
+                        'beacon': INTERNET_QUEUE_SIZE_BEACON}
+
+def create_session() -> requests.Session:
+    """
+    Create a session that keeps the connections to an endpoint alive,
+    so not every message needs a new tcp connection (and tls handshake).
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=INTERNET_POOL_SIZE, pool_maxsize=INTERNET_POOL_SIZE, max_retries=0)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class CircuitBreaker:
+    """
+    Retry state of an endpoint.
+
+    Every failure increases the retry delay exponentially (up to a cap), with full jitter,
+    so not all devices retry in lockstep after the backend went down.
+    After `threshold` consecutive failures the breaker opens: after the delay only a single message is sent as probe
+    (half open), and only if it succeeds sending continues normally (closed).
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int = 3, base_delay: float = 2, max_delay: float = 300):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.state = CircuitBreaker.CLOSED
+
+    def record_success(self):
+        if self.state != CircuitBreaker.CLOSED:
+            logger.info("internet endpoint reachable again, closing circuit breaker")
+        self.failures = 0
+        self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self) -> float:
+        """register a failed attempt and return the time to wait before the next one"""
+        self.failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+            self.state = CircuitBreaker.OPEN
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (self.failures - 1)))
+
+    def retry(self):
+        """the delay is over. An open breaker allows a single probe"""
+        if self.state == CircuitBreaker.OPEN:
+            self.state = CircuitBreaker.HALF_OPEN
+
+    def is_probing(self) -> bool:
+        return self.state == CircuitBreaker.HALF_OPEN
+
+class CompactEncoder:
+    """
+    Encodes a batch of messages into the compact payload format.
+
+    The payload contains the field names only once, followed by one row of values per message:
+    `{'format': 'compact-1', 'static': {id: {field: value}}, 'fields': [...], 'rows': [[...], ...]}`
+    Fields that can be derived from the timestamp (date, time) are dropped.
+    Static fields (rssi threshold, static ratio, location) are sent once per id in `static`
+    and only again after the connection was reset or after `COMPACT_STATIC_INTERVAL` seconds.
+    Transit codes (`close_ble_list`) are sent as base64 of delta varints (see `util.encode_delta_varints`) in `codes`.
+    The payload is sent gzip compressed.
+    """
+
+    def __init__(self):
+        # id -> static values the backend already knows
+        self.static_sent: Dict[str, Dict] = {}
+        self.static_reset: float = monotonic()
+
+    def reset(self):
+        """forget which static values were sent, e.g. when the connection was reset"""
+        self.static_sent.clear()
+        self.static_reset = monotonic()
+
+    def encode(self, messages: List[Dict]) -> Tuple[Dict, Dict]:
+        """
+        Return the payload and the static values contained in it.
+        Call `confirm` with the static values after the payload was sent successfully.
+        """
+        if monotonic() - self.static_reset > COMPACT_STATIC_INTERVAL:
+            self.reset()
+
+        static = {}
+        rows = []
+        for message in messages:
+            message = {key: value for key, value in message.items() if key not in COMPACT_DROPPED_FIELDS}
+
+            values = {key: message[key] for key in COMPACT_STATIC_FIELDS if key in message}
+            if values:
+                id = str(message.get('id'))
+                known = static.get(id, self.static_sent.get(id))
+                if known is None:
+                    static[id] = known = values
+                # messages with different static values (e.g. spooled before a config change) keep them inline
+                if known == values:
+                    for key in values:
+                        del message[key]
+
+            if 'close_ble_list' in message:
+                codes = util.encode_delta_varints(message.pop('close_ble_list'))
+                message['codes'] = base64.b64encode(codes).decode()
+            rows.append(message)
+
+        fields = list(dict.fromkeys(key for message in rows for key in message))
+        payload = {'format': COMPACT_FORMAT, 'fields': fields, 'rows': [[message.get(field) for field in fields] for message in rows]}
+        if static:
+            payload['static'] = static
+        return payload, static
+
+    def confirm(self, static: Dict):
+        self.static_sent.update(static)
+
+class UploadEndpoint:
+    """
+    A single upload endpoint (url and queue) inside the internet process.
+
+    Every endpoint is served by its own thread (`run()`), with its own retry state (see `CircuitBreaker`) and metrics.
+    So a failing endpoint never delays the others.
+    Messages are moved from the queue into a persistent spool (see `UploadSpool`) as soon as they arrive,
+    and removed from it only after they were sent. Messages that could not be sent are sent after the next start.
+    After an outage, the newest messages are sent first and the backlog is sent in the background.
+    Messages are sent in batches of up to `batch_size` messages as a json list.
+    With a batch size of 1, single messages are sent as they are (unless `always_list` is set).
+    With `compact`, batches are sent in the compact format (see `CompactEncoder`) until the backend rejects it.
+    """
+
+    def __init__(self, name: str, url: str, queue: mp.Queue, stop_event: mp.Event,
+                 batch_size: int = 1, always_list: bool = False, compact: bool = False,
+                 on_state_change: Callable[[], None] = lambda: None):
+        """
+        Keyword arguments:
+        stop_event -- set when the process should stop
+
+        on_state_change -- called after every sending attempt, used to update the LEDs
+        """
+        self.name = name
+        self.url = url
+        self.queue = queue
+        self.stop_event = stop_event
+        self.batch_size = max(1, batch_size)
+        self.always_list = always_list
+        self.encoder: CompactEncoder = CompactEncoder() if compact else None
+        self.on_state_change = on_state_change
+        self.batch_started: float = 0
+        self.live_from: int = 0
+        self.live_count: int = 0
+        self.next_backfill: float = 0
+        self.stopped: bool = False
+        self.failing: bool = False
+        self.breaker = CircuitBreaker(Config.Internet.breaker_threshold, Config.Internet.backoff_base, Config.Internet.backoff_max)
+        self.retry_at: float = None
+        # created in the sender thread, neither connections nor sqlite can be shared between threads
+        self.session: requests.Session = None
+        self.spool: UploadSpool = None
+        self.metrics = {'requests': 0, 'messages': 0, 'failures': 0, 'bytes': 0, 'last_success': None}
+
+    def get_spool_path(self) -> str:
+        if not Config.Internet.spool_dir:
+            return SPOOL_MEMORY
+        return os.path.join(Config.Internet.spool_dir, f"{self.name}.db")
+
+    def get_payload(self, messages: List) -> Union[Dict, List]:
+        if self.batch_size == 1 and not self.always_list:
+            return messages[0]
+        return list(messages)
+
+    def pending(self) -> int:
+        return 0 if self.spool is None else len(self.spool)
+
+    def is_connected(self) -> bool:
+        return not self.failing and self.breaker.state == CircuitBreaker.CLOSED
+
+    def is_stacking(self) -> bool:
+        return self.pending() > max(INTERNET_STACKING_THRESHOLD, self.batch_size)
+
+    def get_metrics(self) -> Dict:
+        retry_in = None if self.retry_at is None else round(max(0, self.retry_at - monotonic()), 1)
+        return dict(self.metrics, pending=self.pending(), backlog=self.backlog() if self.spool else 0, failing=self.failing, compact=self.encoder is not None,
+                    breaker=self.breaker.state, consecutive_failures=self.breaker.failures, retry_in=retry_in)
+
+    def run(self):
+        """
+        Serve this endpoint until a STOP message is received, then send what is left
+        within `Config.Internet.shutdown_timeout` seconds.
+        The thread blocks on the queue while idle and only wakes up for new messages, retries or backfills.
+        """
+        self.session = create_session()
+        self.spool = UploadSpool(self.get_spool_path(), Config.Internet.spool_max_messages,
+                                 int(Config.Internet.spool_max_mb * 1024 * 1024))
+        # messages left from the last run are backlog
+        self.live_from = self.spool.last_offset
+        self.live_count = 0 if Config.Internet.newest_first else len(self.spool)
+        self.batch_started = monotonic()
+        while not self.stopped and not self.stop_event.is_set():
+            self.process()
+        self.send_remaining(monotonic() + Config.Internet.shutdown_timeout)
+        logger.info(f"internet {self.name} sender finished. metrics: {self.get_metrics()}")
+        self.spool.close()
+
+    def backlog(self) -> int:
+        return len(self.spool) - self.live_count
+
+    def _live_due(self) -> float:
+        """time (monotonic) when the live batch should be sent"""
+        if self.live_count >= self.batch_size or self.stopped:
+            return 0
+        return self.batch_started + Config.Internet.batch_linger
+
+    def receive(self, timeout: float = None):
+        """
+        Move messages from the queue into the spool.
+        Blocks for up to `timeout` seconds (forever if None) until the first message arrives.
+        """
+        messages = []
+        try:
+            msg = self.queue.get(timeout=timeout) if timeout is None or timeout > 0 else self.queue.get_nowait()
+            while True:
+                if msg == "STOP":
+                    self.stopped = True
+                    break
+                if isinstance(msg, list):
+                    messages.extend(msg)
+                else:
+                    messages.append(msg)
+                msg = self.queue.get_nowait()
+        except Empty:
+            pass
+
+        if messages:
+            if self.live_count == 0:
+                self.batch_started = monotonic()
+            self.spool.append(messages)
+            self.live_count = min(self.live_count + len(messages), len(self.spool))
+
+    def wait(self, delay: float):
+        """wait before the next retry, but keep moving new messages into the spool"""
+        deadline = monotonic() + delay
+        while not self.stopped and not self.stop_event.is_set() and monotonic() < deadline:
+            self.receive(deadline - monotonic())
+
+    def process(self) -> bool:
+        """
+        Receive messages and send the next batch from the spool.
+
+        Live messages (received since the last live batch) are sent first, newest first, so the backend is always up to date.
+        A live batch that is not full yet is held back for up to `Config.Internet.batch_linger` seconds to wait for more messages.
+        Older messages (backlog, e.g. after an outage) are sent oldest first, one batch every `Config.Internet.backfill_interval` seconds.
+        Return true if a sending attempt was made.
+        """
+        due = []
+        if self.live_count > 0:
+            due.append(self._live_due())
+        if self.backlog() > 0:
+            due.append(self.next_backfill)
+        self.receive(max(0, min(due) - monotonic()) if due else None)
+
+        now = monotonic()
+        if self.live_count > 0 and now >= self._live_due():
+            batch = self.spool.peek_newest(self.batch_size, self.live_from) if Config.Internet.newest_first else self.spool.peek(self.batch_size)
+            live = True
+        elif self.backlog() > 0 and now >= self.next_backfill:
+            # the backlog are the oldest messages, live messages are not taken along
+            batch = self.spool.peek(min(self.batch_size, self.backlog()))
+            live = False
+        else:
+            return False
+
+        probe = self.breaker.is_probing()
+        success = self._send_batch(batch[:1] if probe else batch)
+        logger.debug(f"internet sending success for {self.name}: {success} (live: {live}, probe: {probe})")
+
+        if success:
+            self.breaker.record_success()
+            if not live:
+                self.next_backfill = monotonic() + Config.Internet.backfill_interval
+            elif Config.Internet.newest_first and not probe:
+                # everything older than this batch is backlog now
+                self.live_from = self.spool.last_offset
+                self.live_count = 0
+            else:
+                self.live_count = max(0, self.live_count - (1 if probe else len(batch)))
+        else:
+            delay = self.breaker.record_failure()
+            logger.debug(f"internet {self.name} retry in {delay:.1f}s, breaker {self.breaker.state}")
+            self.retry_at = monotonic() + delay
+            self.on_state_change()
+            # returns early when stopping
+            self.wait(delay)
+            self.retry_at = None
+            self.breaker.retry()
+        return True
+
+    def _send_batch(self, batch: List[Tuple[int, Any]], timeout: float = INTERNET_REQUEST_TIMEOUT) -> bool:
+        """send the given (offset, message) pairs of the spool and remove them from it if successful"""
+        messages = [message for _, message in batch]
+        logger.debug(f"sending {len(messages)} messages from {self.name} spool")
+        success = self._post(messages, timeout)
+        self._record_result(batch, success)
+        return success
+
+    def _record_result(self, batch: List[Tuple[int, Any]], success: bool):
+        """update the spool and metrics after a sending attempt"""
+        self.metrics['requests'] += 1
+        if success:
+            self.spool.remove([offset for offset, _ in batch])
+            self.metrics['messages'] += len(batch)
+            self.metrics['last_success'] = datetime.now().isoformat()
+        else:
+            self.metrics['failures'] += 1
+        self.failing = not success
+
+        self.on_state_change()
+
+    def _post(self, messages: List, timeout: float) -> bool:
+        """
+        Try to send the messages to the upstream, compact if enabled.
+        Return true if sending process was successfull.
+        """
+        while True:
+            body, headers, static = self._encode(messages)
+            status = self._request(body, headers, timeout)
+            if not self._handle_response(status, static):
+                return status == 200
+
+    def _encode(self, messages: List) -> Tuple[bytes, Dict, Dict]:
+        """
+        Return body and headers of the request, and the static values sent in it (None if sent as plain json).
+        Encoding, metrics and the fallback to plain json (see `_handle_response`) are only used from one thread,
+        only `_request` may run concurrently.
+        """
+        if self.encoder is not None:
+            payload, static = self.encoder.encode(messages)
+            body = gzip.compress(json.dumps(payload, separators=(',', ':')).encode())
+            headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        else:
+            static = None
+            body = json.dumps(self.get_payload(messages)).encode()
+            headers = {'Content-Type': 'application/json'}
+        self.metrics['bytes'] += len(body)
+        return body, headers, static
+
+    def _handle_response(self, status: int, static: Dict) -> bool:
+        """update the compact encoder after a request. Return true if the messages have to be sent again as plain json"""
+        if static is None or self.encoder is None:
+            return False
+        if status in COMPACT_REJECTED_STATUS:
+            logger.warn(f"internet {self.name}: backend does not support compact format (status {status}), sending plain json")
+            self.encoder = None
+            return True
+        if status == 200:
+            self.encoder.confirm(static)
+        elif status is None:
+            # the connection may have been reset, the backend may not know the static values anymore
+            self.encoder.reset()
+        return False
+
+    def _request(self, body: bytes, headers: Dict, timeout: float) -> int:
+        """post the body and return the status code, or None if no response was received"""
+        logger.debug(f"sending internet message to {self.url} ...")
+        try:
+            response = self.session.post(self.url, data=body, headers=headers, timeout=timeout)
+            return response.status_code
+        except requests.ConnectionError as e:
+            # the pooled connection may be broken (e.g. after the mobile connection dropped)
+            logger.error(f"Connection error while sending message to internet: {e}")
+            self.session.close()
+            self.session = create_session()
+            return None
+        except Exception as e:
+            logger.error(f"Error while sending message to internet: {e}")
+            return None
+
+    def send_remaining(self, deadline: float):
+        """
+        Spool everything left in the queue and send as much as possible in batches until the deadline (monotonic).
+        Live messages are sent first (newest first, if enabled).
+        Stops at the first failure and does not try at all if the endpoint is failing already.
+        Everything that was not sent stays in the spool for the next start, so this returns in bounded time.
+        """
+        self.receive(0)
+        if self.failing or self.breaker.state != CircuitBreaker.CLOSED:
+            logger.info(f"internet {self.name} not reachable: {len(self.spool)} messages kept in spool for next start")
+            return
+
+        sent = 0
+        while len(self.spool) > 0:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            if Config.Internet.newest_first and self.live_count > 0:
+                batch = self.spool.peek_newest(self.batch_size, self.live_from)
+            else:
+                batch = self.spool.peek(self.batch_size)
+            if not batch or not self._send_batch(batch, timeout=min(INTERNET_REQUEST_TIMEOUT, remaining)):
+                break
+            sent += len(batch)
+            self.live_count = max(0, self.live_count - len(batch))
+
+        if len(self.spool) > 0:
+            logger.info(f"internet {self.name}: sent {sent} messages at shutdown, {len(self.spool)} kept in spool for next start")
 
 class InternetController:
     """
@@ -25,11 +459,17 @@ class InternetController:
     These messages will get sent to the specified `url` endpoint.
     When also given a LEDCommunicator, this instance will give information about its current state.
 
-    Stop the process by calling `stop()`. This will terminate the loop safely, with trying to send all
-    enqueued messages before exiting.
+    Beacon events are collected in their own queue and sent in batches (a json list of events)
+    to the beacon url. Count and transit messages are batched as well if `Config.Internet.batch_size` is
+    greater than 1, which makes recovering from a longer outage much faster.
+    Every endpoint is served independently (see `UploadEndpoint`).
+
+    Stop the process by calling `stop()`. This will terminate the loop safely, with trying to send the
+    enqueued messages for up to `Config.Internet.shutdown_timeout` seconds before exiting.
+    Messages that could not be sent are kept in the spool for the next start.
     """
 
-    def __init__(self, count_url='', transit_url='', led_communicator:LEDCommunicator=None):
+    def __init__(self, count_url='', transit_url='', beacon_url='', led_communicator:LEDCommunicator=None):
         self.led_communicator: LEDCommunicator = led_communicator
 
         # counting function
@@ -40,6 +480,16 @@ class InternetController:
         self.transit_url: str = transit_url
         self.transit_queue = mp.Queue()
 
+        # beacon events
+        self.beacon_url: str = beacon_url
+        self.beacon_queue = mp.Queue()
+
+        self.stop_event = mp.Event()
+
+        self.endpoints: List[UploadEndpoint] = []
+        self.state_lock: threading.Lock = None
+        self.led_states: Dict[LEDState, bool] = {}
+
         self.process: mp.Process
         self.ready: bool = False
         self.running: bool = False
@@ -50,6 +500,9 @@ class InternetController:
     def set_transit_url(self, url:str):
         self.transit_url = url
 
+    def set_beacon_url(self, url:str):
+        self.beacon_url = url
+
     def set_led_communicator(self, communicator: LEDCommunicator):
         self.led_communicator = communicator
 
@@ -69,14 +522,27 @@ class InternetController:
 
     def stop(self):
         """
-        Stop the process and terminate safely. Try to send remaining messages before exiting
+        Stop the process and terminate safely. Try to send remaining messages before exiting.
+        Returns after at most `Config.Internet.shutdown_timeout` seconds (plus a short grace period),
+        e.g. to power off the device promptly after an outage.
         """
         if not self.running:
             return
         logger.debug("internet process stop call")
-        self.count_queue.put("STOP")
-        self.transit_queue.put("STOP")
-        self.process.join()
+        self.stop_event.set()
+        queues = [self.count_queue, self.transit_queue, self.beacon_queue]
+        for queue in queues:
+            queue.put("STOP")
+        self.process.join(Config.Internet.shutdown_timeout + INTERNET_SHUTDOWN_GRACE)
+
+        if self.process.is_alive():
+            # spooled messages are safe, sqlite recovers from an interrupted write
+            logger.warn("internet process did not finish in time, terminating it")
+            self.process.terminate()
+            self.process.join()
+            for queue in queues:
+                # do not block at exit on messages nobody will read anymore
+                queue.cancel_join_thread()
         self.running = False
         logger.info("--- Internet process shut down ---")
 
@@ -86,13 +552,24 @@ class InternetController:
     def enqueue_transit_message(self, message: str):
         self._enqueue_message(self.transit_queue, message, 'transit') 
 
-    def _enqueue_message(self, queue: mp.Queue, message: str, queue_name: str):
+    def enqueue_beacon_message(self, message: Dict):
+        self._enqueue_message(self.beacon_queue, message, 'beacon')
+
+    def enqueue_count_messages(self, messages: List):
+        self._enqueue_message(self.count_queue, messages, 'count')
+
+    def enqueue_transit_messages(self, messages: List):
+        self._enqueue_message(self.transit_queue, messages, 'transit')
+
+    def enqueue_beacon_messages(self, messages: List[Dict]):
+        self._enqueue_message(self.beacon_queue, messages, 'beacon')
+
+    def _enqueue_message(self, queue: mp.Queue, message: Union[str, Dict, List], queue_name: str):
         """
-        Enqueue a message to be sent.
+        Enqueue a message (or a list of messages, passed through the queue at once) to be sent.
         If the Queue is already full, older data will be dropped to add this message
         """
-        if (queue_name == 'count' and queue.qsize() >= INTERNET_QUEUE_SIZE_COUNT) or \
-           (queue_name == 'transit' and queue.qsize() >= INTERNET_QUEUE_SIZE_TRANSIT):
+        if queue.qsize() >= INTERNET_QUEUE_SIZES[queue_name]:
             logger.warn(f"internet {queue_name} queue full. Dropping old data")
             queue.get()
         queue.put(message)
@@ -102,73 +579,53 @@ class InternetController:
     def _run(self):
         """
         Private method that is actually executed as a process.
+        Starts a sender thread for every configured endpoint and waits for them to finish,
+        logging their metrics every `INTERNET_METRICS_INTERVAL` seconds.
         """
-        count_message = None
-        transit_message = None
+        self.state_lock = threading.Lock()
+        self.endpoints = self._create_endpoints(UploadEndpoint)
+
+        threads = [threading.Thread(target=endpoint.run, name=f"internet-{endpoint.name}", daemon=True)
+                   for endpoint in self.endpoints]
+        for thread in threads:
+            thread.start()
+        while not self.stop_event.wait(INTERNET_METRICS_INTERVAL):
+            self._log_metrics()
+        for thread in threads:
+            thread.join()
 
-        while True:
-            if Config.led:
-                stacking = (
-                    self.count_queue.qsize() > INTERNET_STACKING_THRESHOLD or 
-                    self.transit_queue.qsize() > INTERNET_STACKING_THRESHOLD
-                )
-                self._set_state(LEDState.INTERNET_STACKING, stacking)
-
-            count_message = self._process_queue(self.count_url, self.count_queue, count_message, "count")
-            if count_message == "STOP":
-                break
-
-            transit_message = self._process_queue(self.transit_url, self.transit_queue, transit_message, "transit")
-            if transit_message == "STOP":
-                break
-
-            if count_message is None and transit_message is None:
-                sleep(0.1)
-        logger.debug("internet process stopping safely. Send remaining messages")
-        self._send_remaining_message(self.count_url, self.count_queue, "count")
-        self._send_remaining_message(self.transit_url, self.transit_queue, "transit")
         logger.debug("internet process finished")
-            
-    def _process_queue(self, url: str, queue: mp.Queue, message: Union[Dict, None], queue_name: str) -> Union[Dict, None]:
-        if message is not None:
-            success = self._send_message(message, url)
-            logger.debug(f"internet sending success for {queue_name}: {success} ")
-            if success:
-                if Config.led:
-                    self._set_state(LEDState.NO_INTERNET_CONNECTION, False)
-                return None
-            else:
-                if Config.led:
-                    self._set_state(LEDState.NO_INTERNET_CONNECTION, True)
-                sleep(2)
-                return message
-
-        elif queue.qsize() > 0:
-            logger.debug(f"retrieving next internet message from {queue_name} queue")
-            msg = queue.get()
-            if msg == "STOP":
-                return "STOP"
-            return msg
-        return None
-
-    def _send_message(self, message: Dict, url: str, timeout=5) -> bool:
-        """
-        Try to send a single message to the upstream.
-        Return true if sending process was successfull.
-        """
-        logger.debug(f"sending internet message to {url} ...")
-        try:
-            response = requests.post(url, json=message, timeout=timeout)
-            return response.status_code == 200
-        except Exception as e:
-            logger.error(f"Error while sending message to internet: {e}")
-            return False
 
-    def _send_remaining_message(self, url: str, queue: mp.Queue, queue_name: str):
-        while queue.qsize() > 0:
-            logger.debug(f"internet remaining in {queue_name} queue: {queue.qsize()}")
-            message = queue.get()
-            self._send_message(message, url, timeout=0.5)
+    def _log_metrics(self):
+        for endpoint in self.endpoints:
+            logger.info(f"internet {endpoint.name} metrics: {endpoint.get_metrics()}")
+
+    def _create_endpoints(self, endpoint_class: type, **kwargs) -> List[UploadEndpoint]:
+        """create the endpoints that have an url. Additional keyword arguments are passed to every endpoint"""
+        endpoints = [
+            endpoint_class('count', self.count_url, self.count_queue, self.stop_event, Config.Internet.batch_size,
+                           compact=Config.Internet.compact, on_state_change=self._update_led_state, **kwargs),
+            endpoint_class('transit', self.transit_url, self.transit_queue, self.stop_event, Config.Internet.batch_size,
+                           compact=Config.Internet.compact, on_state_change=self._update_led_state, **kwargs),
+            endpoint_class('beacon', self.beacon_url, self.beacon_queue, self.stop_event,
+                           INTERNET_BEACON_BATCH_SIZE, always_list=True, on_state_change=self._update_led_state, **kwargs)
+        ]
+        # endpoints without url never receive messages
+        return [endpoint for endpoint in endpoints if endpoint.url]
+
+    def _update_led_state(self):
+        if not Config.led:
+            return
+        states = {
+            LEDState.INTERNET_STACKING: any(endpoint.is_stacking() for endpoint in self.endpoints),
+            LEDState.NO_INTERNET_CONNECTION: not all(endpoint.is_connected() for endpoint in self.endpoints)
+        }
+        with self.state_lock:
+            # only talk to the led process if something changed
+            for state, value in states.items():
+                if self.led_states.get(state) != value:
+                    self.led_states[state] = value
+                    self._set_state(state, value)
 
     def _set_state(self, state: LEDState, value: bool):
         if self.led_communicator is not None:
@@ -179,6 +636,7 @@ class InternetStorage:
     Storage adapter for internet connection.
 
     Implements the method `save_from_count` to be seen as storage from the count functionality.
+    Implements `save_beacon_enter` and `save_beacon_stay` to forward beacon events from BleBeacon.
 
     It brings the data in the right format and prepares it to send
     """
@@ -226,10 +684,8 @@ class InternetStorage:
 
             self.com.enqueue_count_message(params)
 
-    def save_transit(self, id: int, timestamp: str, close_ble_list: list):
-        
-        close_ble_list = list(close_ble_list) # needed to enforce evaluation and make sure data are sent
-
+    def save_transit(self, id: int, timestamp: str, close_ble_list: Tuple[int], seen: Dict = None):
+        """close_ble_list is an immutable snapshot, so it can be enqueued without copying"""
         if Config.Transit.use_internet:
             params = {
                 'id':id,
@@ -237,4 +693,25 @@ class InternetStorage:
                 'close_ble_list':close_ble_list
             }
 
+            if seen is not None:
+                # seconds relative to the timestamp of this window, aligned with close_ble_list
+                reference = datetime.fromisoformat(timestamp).timestamp()
+                params['first_seen'] = [round(seen[code][0] - reference) for code in close_ble_list]
+                params['last_seen'] = [round(seen[code][1] - reference) for code in close_ble_list]
+                params['rssi_max'] = [seen[code][2] for code in close_ble_list]
+
             self.com.enqueue_transit_message(params)
+
+    def save_beacon_enter(self, id: int, time: datetime, rssi: int, manufacturer_data: Dict):
+        if Config.Beacon.use_internet:
+            event = prepare_beacon_event(id, time, BEACON_EVENT_ENTER, 0, rssi, manufacturer_data)
+            self.com.enqueue_beacon_message(event)
+
+    def save_beacon_stay(self, id: int, time: datetime, staying_time: int, rssi_list: List, manufacturer_data: Dict):
+        if Config.Beacon.use_internet:
+            event = prepare_beacon_event(id, time, BEACON_EVENT_EXIT, staying_time, mean(rssi_list), manufacturer_data)
+            self.com.enqueue_beacon_message(event)
+
+    def save_beacon_scan(self, id, time, beacons):
+        # single scans are only stored locally
+        pass
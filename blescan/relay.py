@@ -0,0 +1,166 @@
+from collections import defaultdict
+from datetime import datetime
+from matching import TransitMatcher
+from network import InternetController
+from queue import Empty, Full
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+from xbee import decode_counts, decode_beacon_batch, is_beacon_message, is_transit_message, TransitReassembler
+import logging
+import multiprocessing as mp
+import threading
+
+logger = logging.getLogger('blescan.Relay')
+
+# frames waiting to be decoded. Frames received while the queue is full are dropped
+RELAY_QUEUE_SIZE = 2000
+# messages of a node and kind that are handed to the internet controller at once
+RELAY_BATCH_SIZE = 50
+# seconds a message waits for more messages of the same node and kind
+RELAY_LINGER = 1
+RELAY_METRICS_INTERVAL = 300
+
+class XBeeRelay:
+    """
+    Forwards the data that a coordinator (internet node) receives over xbee to the internet controller.
+
+    The xbee callback (`receive`) runs on the reader thread of the digi library inside the xbee process,
+    so it only puts the raw frame into a multiprocessing queue and returns. A thread in the process that
+    started the relay decodes the frames, collects the messages per source node and kind for up to
+    `linger` seconds or `batch_size` messages, and hands every batch to the internet controller at once.
+
+    Create and start the relay before the xbee process is started, and stop it after the xbee process
+    was stopped (and before the internet controller), so the last messages are forwarded.
+    """
+
+    def __init__(self, internet: InternetController, batch_size: int = RELAY_BATCH_SIZE, linger: float = RELAY_LINGER):
+        self.internet = internet
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.queue = mp.Queue(RELAY_QUEUE_SIZE)
+        # frames dropped by the xbee process, because the queue was full
+        self.dropped = mp.Value('i', 0)
+        self.reassembler = TransitReassembler()
+        # travel times between the nodes, computed from the relayed transit windows
+        self.matcher = TransitMatcher()
+        # (kind, node) -> (time of the first message, messages)
+        self.pending: Dict[Tuple[str, Any], Tuple[float, List]] = {}
+        self.metrics: Dict[str, int] = defaultdict(int)
+        self.started: float = None
+        self.thread: threading.Thread = None
+
+    def start(self):
+        self.started = monotonic()
+        self.thread = threading.Thread(target=self._run, name="xbee-relay", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """forward what was received so far and stop the relay thread"""
+        if self.thread is None:
+            return
+        self.queue.put("STOP")
+        self.thread.join()
+        self.thread = None
+
+    def receive(self, sender, data: bytes):
+        """xbee message callback. Must not block, it runs on the radio thread"""
+        try:
+            self.queue.put_nowait((str(sender.get_node_id()), bytes(data)))
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+            logger.warn("xbee relay queue full. Dropping received message")
+
+    def get_metrics(self) -> Dict:
+        """counters since the start, with the average throughput per second"""
+        elapsed = monotonic() - self.started if self.started is not None else 0
+        metrics = dict(self.metrics, dropped=self.dropped.value)
+        for key in ('frames', 'messages'):
+            metrics[f"{key}_per_s"] = round(metrics.get(key, 0) / elapsed, 2) if elapsed > 0 else 0
+        return metrics
+
+    def _run(self):
+        last_metrics = monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=self._next_flush())
+            except Empty:
+                item = None
+
+            if item == "STOP":
+                break
+            if item is not None:
+                self._process(*item)
+            # incomplete transit windows are forwarded with the chunks received so far
+            self._add_transit(None, self.reassembler.expire(monotonic()))
+            self._flush()
+
+            if monotonic() - last_metrics > RELAY_METRICS_INTERVAL:
+                last_metrics = monotonic()
+                logger.info(f"xbee relay metrics: {self.get_metrics()}")
+                for (from_node, to_node), distribution in sorted(self.matcher.distributions.items()):
+                    logger.info(f"travel times {from_node} -> {to_node}: {distribution}")
+
+        # transit windows still waiting for chunks are forwarded as they are
+        self._add_transit(None, self.reassembler.flush())
+        self._flush(force=True)
+        logger.info(f"xbee relay finished. metrics: {self.get_metrics()}")
+
+    def _next_flush(self) -> float:
+        """seconds until the oldest pending batch or incomplete transit window is due, None if nothing is pending"""
+        due = [since + self.linger for since, _ in self.pending.values()]
+        if self.reassembler.next_expiry() is not None:
+            due.append(self.reassembler.next_expiry())
+        if not due:
+            return None
+        return max(0, min(due) - monotonic())
+
+    def _process(self, node: str, data: bytes):
+        self.metrics['frames'] += 1
+        self.metrics['bytes'] += len(data)
+        try:
+            if is_beacon_message(data):
+                self._add('beacon', node, decode_beacon_batch(data))
+            elif is_transit_message(data):
+                # transit windows may be split into several frames
+                self._add_transit(node, self.reassembler.add(data))
+            else:
+                # a single frame can contain several count summaries
+                self._add('count', node, decode_counts(data))
+        except Exception as e:
+            self.metrics['errors'] += 1
+            logger.error(f"cannot decode xbee message from {node}: {e}")
+
+    def _add_transit(self, node: str, windows: List):
+        for window in windows:
+            self.matcher.add_record(window['id'], datetime.fromisoformat(window['timestamp']).timestamp(), window['close_ble_list'])
+        self._add('transit', node, windows)
+
+    def _add(self, kind: str, node: str, messages: List):
+        if not messages:
+            return
+        logger.debug(f"received {len(messages)} {kind} messages from xbee {node}")
+        self.metrics[kind] += len(messages)
+        self.metrics['messages'] += len(messages)
+        _, pending = self.pending.setdefault((kind, node), (monotonic(), []))
+        pending.extend(messages)
+
+    def _flush(self, force: bool = False):
+        """hand the batches that are full or waited long enough to the internet controller"""
+        now = monotonic()
+        for key, (since, messages) in list(self.pending.items()):
+            if not force and len(messages) < self.batch_size and now - since < self.linger:
+                continue
+            del self.pending[key]
+            kind = key[0]
+            for i in range(0, len(messages), self.batch_size):
+                self._forward(kind, messages[i:i + self.batch_size])
+
+    def _forward(self, kind: str, messages: List):
+        if kind == 'count':
+            self.internet.enqueue_count_messages(messages)
+        elif kind == 'transit':
+            self.internet.enqueue_transit_messages(messages)
+        else:
+            self.internet.enqueue_beacon_messages(messages)
+        self.metrics['batches'] += 1
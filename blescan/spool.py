@@ -0,0 +1,133 @@
+from typing import Any, List, Tuple
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger('blescan.Spool')
+
+SPOOL_MEMORY = ':memory:'
+# the write ahead log is truncated to this size after checkpoints
+SPOOL_JOURNAL_LIMIT = 1024 * 1024
+
+class UploadSpool:
+    """
+    Persistent fifo queue for messages waiting to be uploaded, stored in a sqlite database.
+
+    Messages are appended as they arrive and stay in the spool until they are sent (removed).
+    Every message gets an increasing offset.
+    Messages that were not sent before blescan stopped (or crashed) are sent after the next start.
+    The spool keeps at most `max_messages` messages and `max_bytes` of data, older messages are dropped when it is full.
+    Space of removed messages is given back to the file system (incremental auto vacuum), so the file does not keep
+    the size it had at the peak of an outage.
+    Only messages that are read are kept in memory, so memory use does not depend on the amount of spooled messages.
+
+    The sqlite connection can only be used from the thread that created the spool.
+    """
+
+    def __init__(self, path: str = SPOOL_MEMORY, max_messages: int = 50000, max_bytes: int = 50 * 1024 * 1024):
+        """
+        Keyword arguments:
+        path -- database file. If it can not be opened, an in-memory database is used instead (not persistent)
+
+        max_messages -- maximum amount of messages in the spool
+
+        max_bytes -- maximum size of the stored messages (database pages in use)
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        try:
+            if path != SPOOL_MEMORY:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self._setup()
+            self.path = path
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Cannot open upload spool {path}, using memory instead: {e}")
+            self.db = sqlite3.connect(SPOOL_MEMORY)
+            self._setup()
+            self.path = SPOOL_MEMORY
+
+        self.count = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        self.last_offset = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        if self.count > 0:
+            logger.info(f"{self.count} messages left in upload spool {self.path}")
+
+    def _setup(self):
+        # free pages are only released by `incremental_vacuum`. Must be set before the first table is created,
+        # spools created without it are converted once with a full vacuum
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.db.execute("VACUUM")
+        # WAL with normal sync is safe against crashes of the program and writes less to the sd card
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(f"PRAGMA journal_size_limit={SPOOL_JOURNAL_LIMIT}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        self.db.commit()
+        self.page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+
+    def __len__(self):
+        return self.count
+
+    def size(self) -> int:
+        """bytes used by the stored messages (without free pages)"""
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0] - self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * self.page_size
+
+    def append(self, messages: List[Any]):
+        """append json serializable messages. Drops the oldest messages if the spool is full"""
+        if not messages:
+            return
+        trimmed = False
+        with self.db:
+            self.db.executemany("INSERT INTO messages (payload) VALUES (?)", [(json.dumps(message),) for message in messages])
+            self.count += len(messages)
+            self.last_offset = self.db.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+
+            if self.count > self.max_messages:
+                dropped = self.count - self.max_messages
+                logger.warn(f"upload spool {self.path} full. Dropping {dropped} old messages")
+                self._drop_oldest(dropped)
+
+            size = self.size()
+            if size > self.max_bytes:
+                # estimated from the average message size, repeated until the size fits
+                while size > self.max_bytes and self.count > 0:
+                    dropped = max(1, min(self.count, (size - self.max_bytes) * self.count // size + 1))
+                    logger.warn(f"upload spool {self.path} full ({size} bytes). Dropping {dropped} old messages")
+                    self._drop_oldest(dropped)
+                    size = self.size()
+                trimmed = True
+        if trimmed:
+            self._vacuum()
+
+    def _vacuum(self):
+        """give free pages back to the file system. executescript steps the pragma until all pages are freed"""
+        self.db.executescript("PRAGMA incremental_vacuum;")
+
+    def _drop_oldest(self, amount: int):
+        self.db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)", (amount,))
+        self.count -= amount
+
+    def peek(self, amount: int, after_offset: int = 0) -> List[Tuple[int, Any]]:
+        """return up to `amount` of the oldest messages after the given offset as (offset, message) without removing them"""
+        rows = self.db.execute("SELECT id, payload FROM messages WHERE id > ? ORDER BY id LIMIT ?", (after_offset, amount)).fetchall()
+        return [(offset, json.loads(payload)) for offset, payload in rows]
+
+    def peek_newest(self, amount: int, after_offset: int = 0) -> List[Tuple[int, Any]]:
+        """return up to `amount` of the newest messages after the given offset, in chronological order"""
+        rows = self.db.execute("SELECT id, payload FROM messages WHERE id > ? ORDER BY id DESC LIMIT ?", (after_offset, amount)).fetchall()
+        return [(offset, json.loads(payload)) for offset, payload in reversed(rows)]
+
+    def remove(self, offsets: List[int]):
+        """remove the messages with the given offsets"""
+        with self.db:
+            removed = self.db.executemany("DELETE FROM messages WHERE id = ?", [(offset,) for offset in offsets]).rowcount
+        self.count -= removed
+        if self.count == 0:
+            # the outage is over, give the space back
+            self._vacuum()
+
+    def close(self):
+        self.db.close()
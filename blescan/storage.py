@@ -1,6 +1,6 @@
 from datetime import datetime
 from statistics import pstdev, mean
-from typing import List
+from typing import Dict, List
 from config import Config
 import csv
 import logging 
@@ -18,6 +18,9 @@ FILE_HEADER = {'rssi': 'ID,Time,RSSI list',
                             'Avg RSSI,Std RSSI,Min RSSI,Max RSSI,RSSI thresh,Stat.ratio,Lat,Lon',
                 'transit': 'ID,Time,Close list'}
 
+BEACON_EVENT_ENTER = 'enter'
+BEACON_EVENT_EXIT = 'exit'
+
 class Storage:
     """
     This class encapsulates the storage interface to make it easily reusable for different locations
@@ -138,17 +141,28 @@ class Storage:
 
         self._save_beacon_scan(beacon_scan_row)
 
-    def save_beacon_stay(self, id, time, staying_time, rssi_list, manufacturer_data):
+    def save_beacon_stay(self, id, time: datetime, staying_time, rssi_list, manufacturer_data):
 
         # saves devices given by BleBeacon
         # this includes the beacon file
 
-        beacon_row = prepare_row_data_beacon(id, time, staying_time, rssi_list, manufacturer_data)
+        beacon_row = prepare_row_data_beacon(id, util.format_datetime_old(time), staying_time, rssi_list, manufacturer_data)
         self._save_beacon_stay(beacon_row)
 
-    def save_transit(self, id, time, transit_list):
+    def save_beacon_enter(self, id, time: datetime, rssi, manufacturer_data):
+        """
+        Enter events are not written locally.
+        The staying time file already contains them as exit time minus staying time.
+        """
+        pass
+
+    def save_transit(self, id, time, transit_list, seen=None):
+        """
+        Saves the anonymized ids of close devices given by BleCount.
+        The list is an already sorted snapshot (tuple) shared with other storages.
+        First and last seen times (`seen`) are only sent to the backend and not stored locally.
+        """
 
-        transit_list.sort()
         transit_row = prepare_row_data_transit(id, time.split('T')[1], transit_list)
 
         self._save_transit(transit_row)
@@ -196,6 +210,18 @@ def prepare_row_data_summary(id: int, time: str, scans: int, scantime: float, rs
     return [id, time, scans, scantime, tot_all, tot_close, inst_all, inst_close, stat_all, stat_close, avg, std, mini, maxi,
             Config.Counting.rssi_close_threshold, Config.Counting.static_ratio, Config.latitude, Config.longitude]
 
+def prepare_beacon_event(id: int, time: datetime, event: str, staying_time: int, rssi: float, manufacturer_data) -> Dict:
+    """
+    Compact representation of a beacon enter or exit event, used for forwarding live trajectories.
+    event is either BEACON_EVENT_ENTER or BEACON_EVENT_EXIT
+    """
+    return {'id': id,
+            'timestamp': util.format_datetime_network(time),
+            'tag': ''.join([manufacturer_data['major'], manufacturer_data['minor']]),
+            'event': event,
+            'stay': staying_time,
+            'rssi': round(rssi, 1)}
+
 def prepare_row_data_beacon(id, timestr, staying_time, rssi_list, manufacturer_data):
     average_rssi = mean(rssi_list)
     tagname = ''.join([manufacturer_data['major'], manufacturer_data['minor']])
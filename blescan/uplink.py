@@ -0,0 +1,228 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from network import InternetController, UploadEndpoint, CircuitBreaker, create_session, INTERNET_METRICS_INTERVAL, INTERNET_REQUEST_TIMEOUT
+from spool import UploadSpool
+from time import monotonic
+from typing import Any, Deque, Dict, List, Set, Tuple
+import asyncio
+import logging
+import requests
+import threading
+
+logger = logging.getLogger('blescan.Uplink')
+
+# messages loaded from the spool into memory per request that may be in flight
+UPLINK_WINDOW_FACTOR = 4
+
+def get_node(message: Any) -> Any:
+    """messages of the same node (id) are sent in order"""
+    return message.get('id') if isinstance(message, dict) else None
+
+class AsyncUploadEndpoint(UploadEndpoint):
+    """
+    Upload endpoint that sends up to `max_in_flight` requests at the same time, driven by an asyncio event loop.
+    With high latency connections (e.g. 4G), a single request at a time limits the throughput to one batch per round trip,
+    which is not enough for a coordinator forwarding the data of many nodes.
+
+    Messages of the same node (id) are sent in order: there is never more than one request per node in flight,
+    so only messages of different nodes are sent concurrently. The oldest messages are sent first.
+    Only the requests themselves are sent by a thread pool (one session per thread). Spool, retry state,
+    encoding and metrics are only used from the event loop.
+    Spool, circuit breaker, compact encoding and shutdown timeout work like in `UploadEndpoint`,
+    sending newest first and `batch_linger` are not used.
+    """
+
+    def __init__(self, *args, max_in_flight: int = 4, **kwargs):
+        # sessions can not be shared between the threads sending concurrently
+        self.local = threading.local()
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = max(1, max_in_flight)
+        self.window = self.max_in_flight * self.batch_size * UPLINK_WINDOW_FACTOR
+        self.received: List = []
+        # node -> messages loaded from the spool and not yet sent, as (offset, message)
+        self.nodes: Dict[Any, Deque[Tuple[int, Any]]] = {}
+        self.busy: Set[Any] = set()
+        self.in_flight: Set[asyncio.Task] = set()
+        self.loaded: int = 0
+        self.loaded_offset: int = 0
+        self.deadline: float = None
+        self.metrics['in_flight'] = 0
+
+    @property
+    def session(self) -> requests.Session:
+        if getattr(self.local, 'session', None) is None:
+            self.local.session = create_session()
+        return self.local.session
+
+    @session.setter
+    def session(self, session: requests.Session):
+        self.local.session = session
+
+    async def run_async(self):
+        """
+        Serve this endpoint until a STOP message is received, then send what is left
+        within `Config.Internet.shutdown_timeout` seconds.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(self.max_in_flight, thread_name_prefix=f"internet-{self.name}")
+        self.spool = UploadSpool(self.get_spool_path(), Config.Internet.spool_max_messages,
+                                 int(Config.Internet.spool_max_mb * 1024 * 1024))
+
+        # the multiprocessing queue can only be read blocking, so it is read by its own thread
+        threading.Thread(target=self._read_queue, name=f"internet-{self.name}-reader", daemon=True).start()
+
+        while True:
+            self._receive()
+            if self.stopped and self.deadline is None:
+                self.deadline = monotonic() + Config.Internet.shutdown_timeout
+            if self.deadline is not None and self._drained():
+                break
+
+            self._load()
+            self._dispatch()
+
+            timeout = None
+            if self.retry_at is not None:
+                timeout = max(0, self.retry_at - monotonic())
+            if self.deadline is not None:
+                remaining = max(0, self.deadline - monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+        if len(self.spool) > 0:
+            logger.info(f"internet {self.name}: {len(self.spool)} messages kept in spool for next start")
+        logger.info(f"internet {self.name} sender finished. metrics: {self.get_metrics()}")
+        # requests still in flight are not waited for, their messages stay in the spool
+        self.executor.shutdown(wait=False)
+        self.spool.close()
+
+    def _drained(self) -> bool:
+        """true if the endpoint is done after a STOP message"""
+        if monotonic() >= self.deadline:
+            return True
+        return not self.in_flight and (len(self.spool) == 0 or self._unreachable())
+
+    def _unreachable(self) -> bool:
+        return self.failing or self.breaker.state != CircuitBreaker.CLOSED
+
+    def _read_queue(self):
+        while True:
+            message = self.queue.get()
+            self.loop.call_soon_threadsafe(self._on_message, message)
+            if message == "STOP":
+                return
+
+    def _on_message(self, message: Any):
+        if message == "STOP":
+            self.stopped = True
+        elif isinstance(message, list):
+            self.received.extend(message)
+        else:
+            self.received.append(message)
+        self.wakeup.set()
+
+    def _receive(self):
+        """move the received messages into the spool"""
+        if self.received:
+            self.spool.append(self.received)
+            self.received = []
+
+    def _load(self):
+        """load the oldest messages not loaded yet from the spool, so at most `window` messages are kept in memory"""
+        if self.loaded >= self.window:
+            return
+        for offset, message in self.spool.peek(self.window - self.loaded, self.loaded_offset):
+            self.nodes.setdefault(get_node(message), deque()).append((offset, message))
+            self.loaded += 1
+            self.loaded_offset = offset
+
+    def _dispatch(self):
+        """start a request for every node that has messages and none in flight, until `max_in_flight` is reached"""
+        if self.retry_at is not None:
+            if monotonic() < self.retry_at:
+                return
+            self.retry_at = None
+            self.breaker.retry()
+
+        if self.deadline is not None and self._unreachable():
+            # stopping, do not wait for the endpoint to come back
+            return
+        probe = self.breaker.is_probing()
+        limit = 1 if probe else self.max_in_flight
+
+        # nodes with the oldest messages first
+        waiting = sorted((messages[0][0], node) for node, messages in self.nodes.items() if messages and node not in self.busy)
+        for _, node in waiting:
+            if len(self.in_flight) >= limit:
+                break
+            messages = self.nodes[node]
+            batch = [messages.popleft() for _ in range(min(1 if probe else self.batch_size, len(messages)))]
+            self.busy.add(node)
+            task = self.loop.create_task(self._send(node, batch, probe))
+            self.in_flight.add(task)
+        self.metrics['in_flight'] = len(self.in_flight)
+
+    async def _send(self, node: Any, batch: List[Tuple[int, Any]], probe: bool):
+        timeout = INTERNET_REQUEST_TIMEOUT
+        if self.deadline is not None:
+            timeout = max(0.1, min(timeout, self.deadline - monotonic()))
+
+        messages = [message for _, message in batch]
+        logger.debug(f"sending {len(messages)} messages of node {node} from {self.name} spool")
+        success = await self._post_async(messages, timeout)
+        logger.debug(f"internet sending success for {self.name}: {success} (node: {node}, probe: {probe})")
+
+        self._record_result(batch, success)
+        if success:
+            self.loaded -= len(batch)
+            self.breaker.record_success()
+        else:
+            # back to the front, to keep the order of this node
+            self.nodes[node].extendleft(reversed(batch))
+            # concurrent failures of the same outage only count once
+            if self.retry_at is None:
+                delay = self.breaker.record_failure()
+                logger.debug(f"internet {self.name} retry in {delay:.1f}s, breaker {self.breaker.state}")
+                self.retry_at = monotonic() + delay
+                self.on_state_change()
+
+        self.busy.discard(node)
+        self.in_flight.discard(asyncio.current_task())
+        self.metrics['in_flight'] = len(self.in_flight)
+        self.wakeup.set()
+
+    async def _post_async(self, messages: List, timeout: float) -> bool:
+        """like `_post`, but only the request runs on the thread pool"""
+        while True:
+            body, headers, static = self._encode(messages)
+            status = await self.loop.run_in_executor(self.executor, self._request, body, headers, timeout)
+            if not self._handle_response(status, static):
+                return status == 200
+
+class AsyncInternetController(InternetController):
+    """
+    Internet controller that sends up to `Config.Internet.max_in_flight` requests per endpoint concurrently
+    (see `AsyncUploadEndpoint`). It is used exactly like `InternetController`.
+    """
+
+    def _run(self):
+        self.state_lock = threading.Lock()
+        self.endpoints = self._create_endpoints(AsyncUploadEndpoint, max_in_flight=Config.Internet.max_in_flight)
+        asyncio.run(self._serve())
+        logger.debug("internet process finished")
+
+    async def _serve(self):
+        metrics = asyncio.create_task(self._log_metrics_periodically())
+        await asyncio.gather(*[endpoint.run_async() for endpoint in self.endpoints])
+        metrics.cancel()
+
+    async def _log_metrics_periodically(self):
+        while True:
+            await asyncio.sleep(INTERNET_METRICS_INTERVAL)
+            self._log_metrics()
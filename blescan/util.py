@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Union, Any
+from typing import Iterable, List, Union, Any
 
 
 DATETIME_FORMAT_NETWORK = "%Y-%m-%d %H:%M:%S"
@@ -24,4 +24,52 @@ def float_or_else(value: str, default: Any = None) -> Union[float,Any]:
     
 def byte_to_hex(byte_array) -> str:
     return ''.join('{:02x}'.format(_) for _ in byte_array)
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    """
+    Encode non-negative integers as variable length bytes (7 bits per byte, highest bit set if more bytes follow).
+    Small values only need a single byte.
+    """
+    encoded = bytearray()
+    for value in values:
+        while value > 0x7f:
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+def decode_varints(data: bytes) -> List[int]:
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+def encode_delta_varints(values: Iterable[int]) -> bytes:
+    """
+    Encode a list of (signed) integers as differences to the previous value.
+    The order is kept. Sorted lists are the most compact, because the differences are small.
+    """
+    deltas = []
+    previous = 0
+    for value in values:
+        delta = value - previous
+        # zigzag: map signed to unsigned, 0, -1, 1, -2, ... -> 0, 1, 2, 3, ...
+        deltas.append(delta * 2 if delta >= 0 else -delta * 2 - 1)
+        previous = value
+    return encode_varints(deltas)
+
+def decode_delta_varints(data: bytes) -> List[int]:
+    values = []
+    previous = 0
+    for delta in decode_varints(data):
+        previous += delta // 2 if delta % 2 == 0 else -(delta + 1) // 2
+        values.append(previous)
+    return values
     
\ No newline at end of file
@@ -1,8 +1,15 @@
 import logging
 import multiprocessing as mp
+import random
+import threading
 import time
+from collections import deque
+from math import sqrt
+from queue import Empty, Full
 from datetime import datetime
-from typing import Dict, List, Any
+from statistics import mean
+from typing import Dict, List, Any, Tuple, Union
+import struct
 
 import serial.tools.list_ports
 from digi.xbee.devices import XBeeDevice
@@ -11,28 +18,150 @@ from digi.xbee.exception import TransmitException,XBeeException,TimeoutException
 import util
 from config import Config
 from led import LEDState
-from storage import prepare_row_data_summary
+from storage import prepare_row_data_summary, prepare_beacon_event, BEACON_EVENT_ENTER, BEACON_EVENT_EXIT
 
 logger = logging.getLogger('blescan.XBee')
 
 XBEE_STACKING_THRESHOLD = 3
+# messages kept in the backlog, and messages waiting in the queue to the xbee process (newer ones are dropped when it is full,
+# e.g. while the xbee device can not be set up)
 XBEE_QUEUE_SIZE = 1000
+# when the queue is full, this many old count windows are merged into one coarser window (see `CountBacklog`)
+XBEE_COALESCE_FACTOR = 6
+# transit chunks waiting in the xbee process (see `TransitBacklog`). The oldest windows are dropped when more arrive
+XBEE_TRANSIT_QUEUE_SIZE = 200
+# beacon events waiting in the xbee process (the oldest are dropped when more arrive) and in the queue to it
+XBEE_BEACON_QUEUE_SIZE = 1000
+# while count summaries or transit chunks are queued, a batch of beacon events is sent after this many of them
+XBEE_BEACON_INTERLEAVE = 4
+# maximum time the sender blocks on the queue. Beacon events and stopping are noticed after at most this time
+XBEE_SENDER_TIMEOUT = 0.5
+# time the xbee process gets to finish after the shutdown timeout (a transmission can take a few seconds), before it is terminated
+XBEE_SHUTDOWN_GRACE = 5
+# minimum time between two discoveries, e.g. while no internet node is reachable
+XBEE_DISCOVERY_INTERVAL = 10
+# discovered nodes are refreshed in the background after this time
+XBEE_DISCOVERY_TTL = 300
+# weight of the latest transmission in the health score of an internet node
+XBEE_ROUTE_SMOOTHING = 0.2
+# even unhealthy internet nodes get some messages, so they can recover
+XBEE_ROUTE_MIN_SCORE = 0.05
+# transmissions faster than this are not preferred any more (seconds)
+XBEE_ROUTE_MIN_LATENCY = 0.05
+# consecutive lost acknowledgements (TimeoutException) until an internet node is considered unreachable
+XBEE_TIMEOUT_LIMIT = 3
+# transit windows whose internet node is remembered, so all chunks of a window are sent to the same node
+XBEE_TRANSIT_ROUTES = 16
+
+# maximum number of bytes fitting into a single zigbee frame (NP parameter without encryption)
+XBEE_MAX_PAYLOAD = 84
+
+# every message is sent with a sequence header: marker, session (random per start of the sender), sequence number.
+# Messages that are sent again after a lost acknowledgement have the same sequence number and are dropped by the receiver
+# The session is wide enough that a restarted sender practically never reuses the last one, whose sequence numbers
+# the receiver still remembers
+SEQUENCE_MARKER = 0x10
+SEQUENCE_HEADER = struct.Struct('<BIH')
+# number of sequence numbers remembered per sender
+XBEE_DEDUP_WINDOW = 64
+# space left for the message itself
+XBEE_MAX_MESSAGE_SIZE = XBEE_MAX_PAYLOAD - SEQUENCE_HEADER.size
+
+# first byte of binary messages, the version of the encoding
+COUNT_FORMAT_V1 = 0x01
+# id, epoch, scans, scantime (ms), tot_all, tot_close, inst_all, inst_close (x1000), stat_all, stat_close,
+# rssi_avg, rssi_std (x100), rssi_min, rssi_max, rssi_thresh, static_ratio (x100), latitude, longitude (x10^7)
+COUNT_STRUCT_V1 = struct.Struct('<BHIHIHHIIHHhHbbbBii')
+# several summaries of the same node in one frame: format, id and static values (rssi_thresh to longitude) once,
+# followed by the values of every window (epoch to rssi_max), as sliced from the single frames
+COUNT_BATCH_V1 = 0x02
+COUNT_RECORD_START = struct.calcsize('<BH')
+COUNT_RECORD_END = struct.calcsize('<BHIHIHHIIHHhHbb')
+COUNT_RECORD_SIZE = COUNT_RECORD_END - COUNT_RECORD_START
+COUNT_BATCH_HEADER_SIZE = COUNT_STRUCT_V1.size - COUNT_RECORD_SIZE
+# summary of several merged windows (see `merge_counts`): like COUNT_FORMAT_V1, followed by the number of windows
+COUNT_MERGED_V1 = 0x04
+COUNT_WINDOWS = struct.Struct('<H')
+# values that can not be measured (no devices, no location)
+COUNT_NONE_INT8 = -128
+COUNT_NONE_INT16 = -32768
+COUNT_NONE_UINT16 = 0xffff
+COUNT_NONE_INT32 = -2**31
+
+# close codes of a transit window, split into chunks that fit into a frame: format, id, epoch, chunk index, number of chunks,
+# followed by the sorted codes of the chunk as delta varints (see `util.encode_delta_varints`), so every chunk can be decoded alone
+TRANSIT_FORMAT_V1 = 0x03
+TRANSIT_HEADER_V1 = struct.Struct('<BHIBB')
+TRANSIT_MAX_CHUNKS = 255
+# incomplete transit windows are forwarded with the chunks received so far after this time (seconds)
+TRANSIT_REASSEMBLY_TIMEOUT = 60
+
+BEACON_MESSAGE_PREFIX = "B"
+BEACON_EVENT_SEPARATOR = ";"
+BEACON_EVENT_CODES = {BEACON_EVENT_ENTER: 'i', BEACON_EVENT_EXIT: 'o'}
 
 def get_configuration(pan_id=1, is_coordinator=False, label=' ') -> Dict:
     params = {'ID': pan_id.to_bytes(8, 'little'), 'CE': (1 if is_coordinator else 0).to_bytes(1, 'little'), 'NI': bytearray(label, "utf8")}
 
     return params
     
-def encode_data(data: Dict) -> str:
-    """encode a dict for sending data to the homepage.
-    ID,Time,Scans,Scantime,Tot.all,Tot.close,Inst.all,Inst.close,Stat.all,Stat.close,Avg RSSI,Std RSSI,Min RSSI,Max RSSI,Stat.ratio,Lat,Lon
-    ignore keys, to reduce bytes that need to be transferred
+def _fixed(value: float, scale: int, none: int) -> int:
+    return none if value is None else round(value * scale)
+
+def _unfixed(value: int, scale: int, none: int) -> Union[float, int]:
+    if value == none:
+        return None
+    return value if scale == 1 else value / scale
+
+def encode_data(data: Dict) -> bytes:
+    """encode a count summary (see `XBeeStorage.save_count`) for sending it to the coordinator.
+    The binary encoding (see `COUNT_STRUCT_V1`) fits into a single zigbee frame.
+    Date and time are not sent, they are derived from the timestamp.
+    Averages are sent as fixed point numbers (inst counts with 3, rssi and ratio with 2 decimals, location with 7).
+    Merged summaries (with `windows`, see `merge_counts`) are sent as COUNT_MERGED_V1.
     """
-    return ",".join([str(v) for v in data.values()])
-
-def decode_data(data: str) -> Dict[str, Any]:
-    """decode data that was encoded with the function above
+    windows = data.get('windows', 1)
+    if windows > 1:
+        frame = encode_data(dict(data, windows=1))
+        return bytes([COUNT_MERGED_V1]) + frame[1:] + COUNT_WINDOWS.pack(min(windows, 0xffff))
+
+    # fromisoformat reads the network format (%Y-%m-%d %H:%M:%S) much faster than strptime
+    epoch = int(datetime.fromisoformat(data['timestamp']).timestamp())
+    return COUNT_STRUCT_V1.pack(COUNT_FORMAT_V1, data['id'], epoch, data['scans'], round(data['scantime'] * 1000),
+                                data['tot_all'], data['tot_close'], round(data['inst_all'] * 1000), round(data['inst_close'] * 1000),
+                                data['stat_all'], data['stat_close'],
+                                _fixed(data['rssi_avg'], 100, COUNT_NONE_INT16), _fixed(data['rssi_std'], 100, COUNT_NONE_UINT16),
+                                _fixed(data['rssi_min'], 1, COUNT_NONE_INT8), _fixed(data['rssi_max'], 1, COUNT_NONE_INT8),
+                                data['rssi_thresh'], round(data['static_ratio'] * 100),
+                                _fixed(data['latitude'], 10**7, COUNT_NONE_INT32), _fixed(data['longitude'], 10**7, COUNT_NONE_INT32))
+
+def decode_data(data: Union[bytes, str]) -> Dict[str, Any]:
+    """decode data that was encoded with the function above.
+    The old csv encoding (ID,Time,Date,Time,Scans,...) of nodes that were not updated yet is still understood.
+    Merged summaries have the number of windows they cover in `windows`, single windows have no such field.
     """
+    if isinstance(data, (bytes, bytearray)) and data[:1] == bytes([COUNT_MERGED_V1]):
+        decoded = decode_data(bytes([COUNT_FORMAT_V1]) + data[1:COUNT_STRUCT_V1.size])
+        decoded['windows'] = COUNT_WINDOWS.unpack_from(data, COUNT_STRUCT_V1.size)[0]
+        return decoded
+
+    if isinstance(data, (bytes, bytearray)) and data[:1] == bytes([COUNT_FORMAT_V1]):
+        (_, id, epoch, scans, scantime, tot_all, tot_close, inst_all, inst_close, stat_all, stat_close,
+         rssi_avg, rssi_std, rssi_min, rssi_max, rssi_thresh, static_ratio, latitude, longitude) = COUNT_STRUCT_V1.unpack(data[:COUNT_STRUCT_V1.size])
+        # same as util.format_datetime_network, but faster
+        timestamp = datetime.fromtimestamp(epoch).isoformat(' ')
+
+        return {'id': id, 'timestamp': timestamp, 'date': timestamp[:10].replace('-', ''),
+                'time': timestamp[11:].replace(':', ''), 'scans': scans, 'scantime': scantime / 1000,
+                'tot_all': tot_all, 'tot_close': tot_close, 'inst_all': inst_all / 1000, 'inst_close': inst_close / 1000,
+                'stat_all': stat_all, 'stat_close': stat_close,
+                'rssi_avg': _unfixed(rssi_avg, 100, COUNT_NONE_INT16), 'rssi_std': _unfixed(rssi_std, 100, COUNT_NONE_UINT16),
+                'rssi_min': _unfixed(rssi_min, 1, COUNT_NONE_INT8), 'rssi_max': _unfixed(rssi_max, 1, COUNT_NONE_INT8),
+                'rssi_thresh': rssi_thresh, 'static_ratio': static_ratio / 100,
+                'latitude': _unfixed(latitude, 10**7, COUNT_NONE_INT32), 'longitude': _unfixed(longitude, 10**7, COUNT_NONE_INT32)}
+
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
     s = data.split(",")
 
     return {'id': int(s[0]), 'timestamp': s[1], 'date': s[2], 'time': s[3], 'scans': int(s[4]), 'scantime': float(s[5]),
@@ -40,6 +169,291 @@ def decode_data(data: str) -> Dict[str, Any]:
             'rssi_avg': float(s[12]), 'rssi_std': float(s[13]), 'rssi_min': int(s[14]), 'rssi_max': int(s[15]), 
             'rssi_thresh': int(s[16]), 'static_ratio': float(s[17]), 'latitude': util.float_or_else(s[18], None), 'longitude': util.float_or_else(s[19], None)}
 
+def count_batch_key(frame: bytes) -> bytes:
+    """frames with the same key (id and static values) can be sent in one batch. None if the frame can not be batched"""
+    if not isinstance(frame, (bytes, bytearray)) or frame[:1] != bytes([COUNT_FORMAT_V1]):
+        return None
+    return frame[1:COUNT_RECORD_START] + frame[COUNT_RECORD_END:]
+
+def count_merge_key(frame: bytes) -> bytes:
+    """summaries with the same key (id and static values) can be merged (see `merge_counts`). None for other messages"""
+    if not isinstance(frame, (bytes, bytearray)) or frame[:1] not in (bytes([COUNT_FORMAT_V1]), bytes([COUNT_MERGED_V1])):
+        return None
+    return frame[1:COUNT_RECORD_START] + frame[COUNT_RECORD_END:COUNT_STRUCT_V1.size]
+
+def encode_count_batch(frames: List[bytes]) -> bytes:
+    """pack single frames (see `encode_data`) with the same `count_batch_key` into one message"""
+    if len(frames) == 1:
+        return frames[0]
+    return bytes([COUNT_BATCH_V1]) + count_batch_key(frames[0]) + b''.join(frame[COUNT_RECORD_START:COUNT_RECORD_END] for frame in frames)
+
+def decode_counts(data: Union[bytes, str]) -> List[Dict[str, Any]]:
+    """decode a message with one or several count summaries (see `encode_count_batch`)"""
+    if not isinstance(data, (bytes, bytearray)) or data[:1] != bytes([COUNT_BATCH_V1]):
+        return [decode_data(data)]
+
+    id = data[1:COUNT_RECORD_START]
+    static = data[COUNT_RECORD_START:COUNT_BATCH_HEADER_SIZE]
+    records = data[COUNT_BATCH_HEADER_SIZE:]
+    return [decode_data(bytes([COUNT_FORMAT_V1]) + id + records[i:i + COUNT_RECORD_SIZE] + static)
+            for i in range(0, len(records) - COUNT_RECORD_SIZE + 1, COUNT_RECORD_SIZE)]
+
+def merge_counts(summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """merge decoded count summaries of consecutive windows of the same node into one summary covering all of them.
+    The merged summary has the timestamp of the last window and the number of windows it covers in `windows`,
+    so the backend can tell it apart from a single window. Scans and scan time are added up, the instantaneous counts
+    are averaged weighted by scans and the rssi values by devices (the std is pooled).
+    Devices can not be matched between windows, so the totals and static counts are the maximum of the windows.
+    """
+    merged = dict(summaries[-1])
+    merged['windows'] = sum(summary.get('windows', 1) for summary in summaries)
+    scans = sum(summary['scans'] for summary in summaries)
+    merged['scans'] = min(scans, 0xffff)
+    merged['scantime'] = sum(summary['scantime'] for summary in summaries)
+    for key in ('tot_all', 'tot_close', 'stat_all', 'stat_close'):
+        merged[key] = max(summary[key] for summary in summaries)
+    if scans > 0:
+        for key in ('inst_all', 'inst_close'):
+            merged[key] = round(sum(summary[key] * summary['scans'] for summary in summaries) / scans, 3)
+
+    measured = [summary for summary in summaries if summary['tot_all'] > 0 and summary['rssi_avg'] is not None]
+    if measured:
+        devices = sum(summary['tot_all'] for summary in measured)
+        avg = sum(summary['rssi_avg'] * summary['tot_all'] for summary in measured) / devices
+        variance = sum(summary['tot_all'] * ((summary['rssi_std'] or 0) ** 2 + (summary['rssi_avg'] - avg) ** 2) for summary in measured) / devices
+        merged['rssi_avg'] = round(avg, 3)
+        merged['rssi_std'] = round(sqrt(variance), 3)
+        merged['rssi_min'] = min(summary['rssi_min'] for summary in measured)
+        merged['rssi_max'] = max(summary['rssi_max'] for summary in measured)
+    return merged
+
+def encode_transit(id: int, timestamp: str, codes: List[int], max_size: int) -> List[bytes]:
+    """encode the close codes of a transit window into as many chunks of at most `max_size` bytes as needed"""
+    epoch = int(datetime.fromisoformat(timestamp).timestamp())
+    space = max_size - TRANSIT_HEADER_V1.size
+
+    chunks = [b'']
+    previous = 0
+    for code in sorted(codes):
+        # same as util.encode_delta_varints of the whole chunk, but the size is known for every code
+        encoded = util.encode_delta_varints([code - previous])
+        if len(chunks[-1]) + len(encoded) > space:
+            if len(chunks) == TRANSIT_MAX_CHUNKS:
+                logger.warn(f"too many transit codes for xbee, dropping {len(codes)} codes after chunk {len(chunks)}")
+                break
+            encoded = util.encode_delta_varints([code])
+            chunks.append(b'')
+        chunks[-1] += encoded
+        previous = code
+
+    return [TRANSIT_HEADER_V1.pack(TRANSIT_FORMAT_V1, id, epoch, index, len(chunks)) + chunk for index, chunk in enumerate(chunks)]
+
+def is_transit_message(data: bytes) -> bool:
+    return isinstance(data, (bytes, bytearray)) and data[:1] == bytes([TRANSIT_FORMAT_V1])
+
+def transit_window(data: bytes) -> Tuple[int, int]:
+    """(id, epoch) of the window a transit chunk belongs to, None if the message is not a transit chunk"""
+    if not is_transit_message(data):
+        return None
+    _, id, epoch, _, _ = TRANSIT_HEADER_V1.unpack_from(data)
+    return id, epoch
+
+def decode_transit(data: bytes):
+    """return (id, epoch, chunk index, number of chunks, codes) of a chunk encoded by `encode_transit`"""
+    _, id, epoch, index, count = TRANSIT_HEADER_V1.unpack_from(data)
+    return id, epoch, index, count, util.decode_delta_varints(data[TRANSIT_HEADER_V1.size:])
+
+class TransitReassembler:
+    """
+    Collects the chunks of transit windows received over xbee.
+    A window is complete when all chunks are received. Incomplete windows (a chunk was lost)
+    are returned with the codes received so far after `TRANSIT_REASSEMBLY_TIMEOUT` seconds,
+    `expire` has to be called regularly for this.
+    """
+
+    def __init__(self, timeout: float = TRANSIT_REASSEMBLY_TIMEOUT):
+        self.timeout = timeout
+        # (id, epoch) -> [time of the first chunk, number of chunks, {index: codes}]
+        self.windows: Dict[tuple, list] = {}
+
+    def add(self, data: bytes) -> List[Dict[str, Any]]:
+        """add a chunk and return the transit messages (see `InternetStorage.save_transit`) that are ready"""
+        id, epoch, index, count, codes = decode_transit(data)
+        now = time.monotonic()
+        window = self.windows.setdefault((id, epoch), [now, count, {}])
+        window[2][index] = codes
+
+        ready = [self._complete((id, epoch))] if len(window[2]) >= count else []
+        return ready + self.expire(now)
+
+    def expire(self, now: float) -> List[Dict[str, Any]]:
+        """return the incomplete windows whose first chunk arrived more than `timeout` seconds before `now` (monotonic)"""
+        expired = [key for key, (received, _, _) in self.windows.items() if now - received > self.timeout]
+        return [self._complete(key) for key in expired]
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """return all incomplete windows with the chunks received so far, e.g. before stopping"""
+        return [self._complete(key) for key in list(self.windows)]
+
+    def next_expiry(self) -> float:
+        """time (monotonic) when the oldest incomplete window expires, None if there is none"""
+        if not self.windows:
+            return None
+        return min(received for received, _, _ in self.windows.values()) + self.timeout
+
+    def _complete(self, key: tuple) -> Dict[str, Any]:
+        (id, epoch), (_, count, chunks) = key, self.windows.pop(key)
+        if len(chunks) < count:
+            logger.warn(f"transit window {epoch} of {id} incomplete: {len(chunks)} of {count} chunks received")
+        codes = [code for index in sorted(chunks) for code in chunks[index]]
+        return {'id': id, 'timestamp': datetime.fromtimestamp(epoch).isoformat(), 'close_ble_list': codes}
+
+class CountBacklog:
+    """
+    Count summaries waiting on a sender node to be sent to an internet node.
+    The newest summaries are sent first, so fresh windows arrive in time even with a backlog after an outage of the mesh.
+
+    At most `max_size` messages are kept. When the backlog is full, the oldest run of `factor` count summaries of the
+    same node and resolution is merged into one coarser summary (see `merge_counts`), e.g. six 10 s windows into one
+    60 s window, later six of these into one 6 min window. A long outage costs resolution of the oldest windows instead
+    of the windows themselves. Only if nothing can be merged anymore, the oldest message is dropped.
+    Transit chunks are kept apart (see `TransitBacklog`), so they never split the runs of summaries.
+    """
+
+    def __init__(self, max_size: int = XBEE_QUEUE_SIZE, factor: int = XBEE_COALESCE_FACTOR):
+        self.max_size = max_size
+        self.factor = max(2, factor)
+        # (message, number of windows, merge key), oldest first
+        self.entries: List[tuple] = []
+        self.merged: int = 0
+        self.dropped: int = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message: bytes):
+        self.entries.append((message, 1, count_merge_key(message)))
+        while len(self.entries) > self.max_size:
+            self._coalesce()
+
+    def pop_batch(self, max_size: int) -> bytes:
+        """remove the newest message, packed with as many summaries of the same node as fit (see `encode_count_batch`)"""
+        message, _, _ = self.entries.pop()
+        frames = [message]
+        key = count_batch_key(message)
+        while (key is not None and self.entries and count_batch_key(self.entries[-1][0]) == key
+               and COUNT_BATCH_HEADER_SIZE + (len(frames) + 1) * COUNT_RECORD_SIZE <= max_size):
+            frames.insert(0, self.entries.pop()[0])
+        return encode_count_batch(frames)
+
+    def _coalesce(self):
+        """make room by merging old count summaries or dropping the oldest message that can not be merged"""
+        # the newer half is kept in full resolution as long as possible
+        older = len(self.entries) // 2
+        run = self._find_run(True, older) or self._find_run(False, older) or self._find_run(False, len(self.entries))
+        if run is None:
+            logger.warn("xbee queue full. Dropping old data")
+            del self.entries[0]
+            self.dropped += 1
+            return
+
+        start, end = run
+        entries = self.entries[start:end]
+        merged = encode_data(merge_counts([decode_data(message) for message, _, _ in entries]))
+        windows = sum(windows for _, windows, _ in entries)
+        self.entries[start:end] = [(merged, windows, count_merge_key(merged))]
+        self.merged += len(entries) - 1
+        logger.debug(f"xbee queue full. Merged {len(entries)} old count summaries into one of {windows} windows")
+
+    def _find_run(self, same_windows: bool, before: int) -> Tuple[int, int]:
+        """
+        Return (start, end) of the oldest run of summaries that can be merged and starts before the given index,
+        None if there is none. With `same_windows`, only full runs of summaries with the same resolution are considered,
+        otherwise any run of at least two summaries.
+        """
+        start = 0
+        for index in range(1, len(self.entries) + 1):
+            first = self.entries[start]
+            if (index < len(self.entries) and index - start < self.factor and first[2] is not None
+                    and self.entries[index][2] == first[2] and (not same_windows or self.entries[index][1] == first[1])):
+                continue
+            length = index - start
+            if first[2] is not None and (length == self.factor or (not same_windows and length > 1)):
+                return start, index
+            start = index
+            if start >= before:
+                return None
+
+class TransitBacklog:
+    """
+    Transit chunks (see `encode_transit`) waiting on a sender node to be sent to an internet node.
+    The newest windows are sent first, like the count summaries. Windows can not be merged, so when more than
+    `max_size` chunks are waiting, all chunks of the oldest window are dropped.
+    """
+
+    def __init__(self, max_size: int = XBEE_TRANSIT_QUEUE_SIZE):
+        self.max_size = max_size
+        # oldest first
+        self.chunks: deque = deque()
+        self.dropped: int = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, chunk: bytes):
+        self.chunks.append(chunk)
+        while len(self.chunks) > self.max_size:
+            window = transit_window(self.chunks[0])
+            while self.chunks and transit_window(self.chunks[0]) == window:
+                self.chunks.popleft()
+            self.dropped += 1
+            logger.warn(f"xbee transit queue full. Dropping old window ({self.dropped} windows dropped)")
+
+    def pop(self) -> bytes:
+        """remove the newest chunk. The chunks of a window are next to each other and sent one after the other"""
+        return self.chunks.pop()
+        return None
+
+def add_sequence(message: Union[bytes, str], session: int, sequence: int) -> bytes:
+    if isinstance(message, str):
+        message = message.encode()
+    return SEQUENCE_HEADER.pack(SEQUENCE_MARKER, session, sequence) + message
+
+def split_sequence(data: bytes):
+    """return (session, sequence, message). Session and sequence are None for messages of nodes without sequence numbers"""
+    if data[:1] != bytes([SEQUENCE_MARKER]) or len(data) < SEQUENCE_HEADER.size:
+        return None, None, data
+    _, session, sequence = SEQUENCE_HEADER.unpack_from(data)
+    return session, sequence, data[SEQUENCE_HEADER.size:]
+
+def encode_beacon_event(event: Dict) -> str:
+    """encode a beacon event (see `storage.prepare_beacon_event`) as short as possible.
+    id,epoch,tag,event,stay,rssi
+    """
+    epoch = int(util.read_network_datetime(event['timestamp']).timestamp())
+    return f"{event['id']},{epoch},{event['tag']},{BEACON_EVENT_CODES[event['event']]},{event['stay']},{event['rssi']}"
+
+def encode_beacon_batch(encoded_events: List[str]) -> str:
+    return BEACON_MESSAGE_PREFIX + BEACON_EVENT_SEPARATOR.join(encoded_events)
+
+def is_beacon_message(data: Union[bytes, str]) -> bool:
+    if isinstance(data, (bytes, bytearray)):
+        return data.startswith(BEACON_MESSAGE_PREFIX.encode())
+    return data.startswith(BEACON_MESSAGE_PREFIX)
+
+def decode_beacon_batch(data: Union[bytes, str]) -> List[Dict[str, Any]]:
+    """decode a batch of beacon events that was encoded with `encode_beacon_batch`
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+    events = []
+    codes = {v: k for k, v in BEACON_EVENT_CODES.items()}
+    for encoded in data[len(BEACON_MESSAGE_PREFIX):].split(BEACON_EVENT_SEPARATOR):
+        s = encoded.split(",")
+        events.append({'id': int(s[0]), 'timestamp': util.format_datetime_network(datetime.fromtimestamp(int(s[1]))),
+                       'tag': s[2], 'event': codes[s[3]], 'stay': int(s[4]), 'rssi': float(s[5])})
+    return events
+
 def auto_find_port():
     ports = serial.tools.list_ports.comports()
 
@@ -61,16 +475,95 @@ def auto_find_port():
 
 
 
+class GatewayRouter:
+    """
+    Distributes the messages of a sender over the reachable internet nodes (gateways),
+    so not all senders use the same gateway while the others stay idle.
+
+    Every gateway has a health score: the success rate and the time until the transmission was acknowledged,
+    both smoothed over the last transmissions. A gateway with a busy radio or uplink acknowledges slower and gets less messages.
+    Gateways are chosen by smooth weighted round robin, with the score as weight.
+    Without `balance`, the first reachable gateway in the configured order is used (failover only).
+    """
+
+    def __init__(self, balance: bool = True):
+        self.balance = balance
+        self.success: Dict[str, float] = {}
+        self.latency: Dict[str, float] = {}
+        self.current: Dict[str, float] = {}
+
+    def get_score(self, gateway: str) -> float:
+        success = self.success.get(gateway, 1.0)
+        latency = max(self.latency.get(gateway, XBEE_ROUTE_MIN_LATENCY), XBEE_ROUTE_MIN_LATENCY)
+        return max(XBEE_ROUTE_MIN_SCORE, success) * XBEE_ROUTE_MIN_LATENCY / latency
+
+    def choose(self, gateways: List[str]) -> str:
+        """choose one of the given (reachable) gateways for the next message"""
+        if not self.balance or len(gateways) == 1:
+            return gateways[0]
+
+        weights = {gateway: self.get_score(gateway) for gateway in gateways}
+        total = sum(weights.values())
+        for gateway, weight in weights.items():
+            self.current[gateway] = self.current.get(gateway, 0) + weight
+        chosen = max(gateways, key=lambda gateway: self.current[gateway])
+        self.current[chosen] -= total
+        return chosen
+
+    def record(self, gateway: str, success: bool, duration: float):
+        """update the health score with the outcome of a transmission"""
+        self.success[gateway] = (1 - XBEE_ROUTE_SMOOTHING) * self.success.get(gateway, 1.0) + XBEE_ROUTE_SMOOTHING * success
+        if success:
+            self.latency[gateway] = (1 - XBEE_ROUTE_SMOOTHING) * self.latency.get(gateway, duration) + XBEE_ROUTE_SMOOTHING * duration
+        logger.debug(f"xbee gateway {gateway} score: {self.get_score(gateway):.3f}")
+
+
 class XBeeController:
 
-    def __init__(self, port='auto', led_communicator=None):
+    def __init__(self, port='auto', led_communicator=None, device_factory=XBeeDevice, label: str = None):
+        """
+        Keyword arguments:
+        device_factory -- creates the device from port and baud rate, e.g. a simulated device (see etc/xbee_simulator.py)
+
+        label -- node id of this device. Default is `Config.XBee.my_label`
+        """
         self.port: str = port
+        self.device_factory = device_factory
+        self.label: str = label
         self.device: XBeeDevice = None
         self.target_ids: List[str] = []
         self.targets: Dict = {}
         self.message_received_callback = lambda s, t: logger.debug(f"message from {t}: {s}")
         self.running: bool = False
-        self.message_queue = mp.Queue()
+        # set by `stop()`, seen by the xbee process (unlike `running`, which only changes in the calling process)
+        self.stop_event = mp.Event()
+        # discovery runs in a background thread of the xbee process (see `_run_discovery`)
+        self.discovery_thread: threading.Thread = None
+        self.discovery_wanted: threading.Event = None
+        self.discovery_stop: threading.Event = None
+        self.discovery_error: Exception = None
+        self.led_states: Dict[LEDState, bool] = {}
+        self.router: GatewayRouter = None
+        # internet node -> consecutive lost acknowledgements
+        self.timeouts: Dict[str, int] = {}
+        # (id, epoch) of a transit window -> internet node its chunks are sent to
+        self.transit_routes: Dict[tuple, str] = {}
+        self.session: int = random.getrandbits(32)
+        self.sequence: int = 0
+        # sender address -> (session, last received sequence numbers)
+        self.received_sequences: Dict[str, tuple] = {}
+        # bounded without asking the other process for the size (see `enqueue_message`)
+        self.message_queue = mp.Queue(XBEE_QUEUE_SIZE)
+        self.beacon_queue = mp.Queue(XBEE_BEACON_QUEUE_SIZE)
+        # messages and beacon events dropped because the queue was full
+        self.dropped = mp.Value('i', 0)
+        # messages moved from the queue by the xbee process
+        self.backlog = CountBacklog()
+        self.transit_backlog = TransitBacklog()
+        self.beacons: deque = deque()
+        self.dropped_beacons: int = 0
+        # count and transit messages sent since the last beacon batch
+        self.streak: int = 0
         self.process = None
         self.is_sender: bool = None
         self.led_communicator = led_communicator
@@ -88,17 +581,18 @@ class XBeeController:
         self.target_ids = Config.XBee.internet_ids
 
         logger.debug(f"setting up xbee device on port {port}")
-        self.device = XBeeDevice(port, Config.XBee.baud_rate)
+        self.device = self.device_factory(port, Config.XBee.baud_rate)
         self.device.open()
 
         self.device.set_pan_id(Config.XBee.pan.to_bytes(8, 'little'))
-        self.device.set_node_id(Config.XBee.my_label)
+        self.device.set_node_id(self.label)
         self.device.set_parameter('CE', (1 if Config.XBee.is_coordinator else 0).to_bytes(1, 'little'))
 
         self.device.apply_changes()
         self.device.write_changes()
 
-        self.device.add_data_received_callback(lambda m: self.message_received_callback(m.remote_device, m.data.decode()))
+        # messages are passed as bytes, count summaries are binary (see `encode_data`)
+        self.device.add_data_received_callback(self._on_data_received)
 
         logger.debug(f"xbee settings: [ \n\
                      PAN: {util.byte_to_hex(self.device.get_pan_id())}, \n\
@@ -112,10 +606,15 @@ class XBeeController:
             self._set_state(LEDState.XBEE_SETUP, False)
 
     def _teardown(self):
+        self._stop_discovery()
         if self.device is not None and self.device.is_open():
             self.device.close()
 
-    def start(self):
+    def start(self, as_thread: bool = False):
+        """
+        Start the xbee process.
+        With `as_thread`, a thread is started instead, so several (simulated) devices can share the same process.
+        """
         if self.running:
             logger.error("Already running a XBee instance")
             return
@@ -123,23 +622,41 @@ class XBeeController:
         logger.info("--- starting XBee process ---")
 
         # determine role
-        self.is_sender = Config.XBee.my_label not in Config.XBee.internet_ids
-
-        self.process = mp.Process(target=self._run, daemon=True)
+        if self.label is None:
+            self.label = Config.XBee.my_label
+        self.is_sender = self.label not in Config.XBee.internet_ids
+
+        if as_thread:
+            self.process = threading.Thread(target=self._run, name=f"xbee-{self.label}", daemon=True)
+        else:
+            self.process = mp.Process(target=self._run, daemon=True)
         self.process.start()
 
         # wait a second for the process to start
         time.sleep(1)
 
     def stop(self):
+        """
+        Stop the xbee process. Queued messages are sent for up to `Config.XBee.shutdown_timeout` seconds,
+        so this returns in bounded time (plus a short grace period), e.g. to power off the device.
+        """
         if not self.running:
             return
         logger.debug("xbee stop call")
         self.running = False
-        self.process.join()
+        self.stop_event.set()
+        self.process.join(Config.XBee.shutdown_timeout + XBEE_SHUTDOWN_GRACE)
+
+        if self.process.is_alive() and isinstance(self.process, mp.Process):
+            logger.warn("xbee process did not finish in time, terminating it")
+            self.process.terminate()
+            self.process.join()
+            for queue in (self.message_queue, self.beacon_queue):
+                # do not block at exit on messages nobody will read anymore
+                queue.cancel_join_thread()
 
     def _run(self):
-        while self.running:
+        while not self.stop_event.is_set():
             try:
                 self._setup()
                 
@@ -158,7 +675,10 @@ class XBeeController:
                 
                 logger.error(e)
                 logger.debug("end of error message")
-                time.sleep(10)
+                # keep moving the enqueued messages into the bounded backlogs while waiting
+                restart = time.monotonic() + 10
+                while not self.stop_event.is_set() and time.monotonic() < restart:
+                    self._receive_messages(min(XBEE_SENDER_TIMEOUT, restart - time.monotonic()))
                 logger.debug("restarting xbee process")
                 if Config.led:
                     self._set_state(LEDState.XBEE_CRASH, False)
@@ -167,82 +687,269 @@ class XBeeController:
         logger.info("--- xbee process finished ---")
 
     def _run_receiver(self):
-        while self.running:
-            # if there are some issues with xbee, the discovery will throw an exception which causes the process to restart
-            logger.debug("xbee receive checkup")
-            self._discover_network(5)
-            logger.debug(f"devices discovered: [{','.join(id for id in self.targets.keys())}]")
-            time.sleep(10)
+        # if there are some issues with xbee, the discovery will throw an exception which causes the process to restart
+        self._start_discovery(5)
+        while not self.stop_event.is_set():
+            self._check_discovery()
+            self.stop_event.wait(1)
 
 
     def _run_sender(self):
-        available_targets = []
+        """
+        Send queued messages to the first reachable internet node.
+        Blocks on the queue while there is nothing to send. While no internet node is reachable,
+        the messages stay queued until the discovery in the background finds one.
+        """
+        self._start_discovery(10)
+        self.router = GatewayRouter(Config.XBee.load_balance)
 
         message = None
+        # internet node that possibly received the current message already
+        retry_target = None
 
-        while self.running:
+        while not self.stop_event.is_set():
+            self._check_discovery()
+            available_targets = self._get_available_targets()
             if len(available_targets) == 0:
                 if Config.led:
                     self._set_state(LEDState.NO_XBEE_CONNECTION, True)
-                logger.debug("No reachable targets. Rescanning")
-                available_targets = self._discover_network()
-                logger.debug(f"available internet nodes: {available_targets}")
+                # keep the backlog bounded while waiting
+                self._receive_messages(XBEE_SENDER_TIMEOUT)
                 continue
-            else:
-                if Config.led:
-                    self._set_state(LEDState.NO_XBEE_CONNECTION, False)
 
             if Config.led:
-                self._set_state(LEDState.XBEE_STACKING, self.message_queue.qsize() > XBEE_STACKING_THRESHOLD)
-
-            # if there is a message, send it to an available target.
-            # if the target happens to not be available (_send_message return false),
-            # remove this target from the available list
-            if message is not None:
+                self._set_state(LEDState.NO_XBEE_CONNECTION, False)
+                self._set_state(LEDState.XBEE_STACKING, len(self.backlog) + len(self.transit_backlog) > XBEE_STACKING_THRESHOLD)
+
+            if message is None:
+                message = self._next_message(XBEE_SENDER_TIMEOUT)
+                if message is None:
+                    continue
+
+            # send the message to an available target.
+            # if the target is not reachable (see `_send_message`), it is removed from the discovered nodes
+            # and another one is used right away
+            # after a lost acknowledgement, the same target is tried again: if it received the message already,
+            # it drops the duplicate (see `_on_data_received`), another target would forward it a second time
+            target = retry_target if retry_target in available_targets else self._choose_target(message, available_targets)
+            start = time.monotonic()
+            success = self._send_message(target, message)
+            self.router.record(target, success, time.monotonic() - start)
+            retry_target = target if not success and target in self.timeouts else None
+            if success:
+                message = None
 
-                target = available_targets[0]
-                success = self._send_message(target, message)
+        # end while
 
-                if success:
-                    message = None
-                else:
-                    available_targets.remove(target)
+        logger.debug("stopping xbee. Clearing queue")
+        deadline = time.monotonic() + Config.XBee.shutdown_timeout
+        available_targets = self._get_available_targets()
+        if len(available_targets) > 0:
+            target = retry_target if retry_target in available_targets else available_targets[0]
+            # first still selected message, stop at the first failure or the deadline
+            if message is None or self._send_message(target, message):
+                message = self._next_message(0)
+                while (message is not None and time.monotonic() < deadline
+                       and self._send_message(target, message)):
+                    message = self._next_message(0)
+
+        if len(self.backlog) > 0 or self.backlog.merged > 0:
+            logger.info(f"xbee queue: {len(self.backlog)} messages not sent, {self.backlog.merged} merged, {self.backlog.dropped} dropped")
+        if len(self.transit_backlog) > 0 or self.transit_backlog.dropped > 0:
+            logger.info(f"xbee transit queue: {len(self.transit_backlog)} chunks not sent, {self.transit_backlog.dropped} windows dropped")
+        logger.debug("xbee process finished")
 
-            elif self.message_queue.qsize() > 0:
-                message = self.message_queue.get()
+    def _choose_target(self, message: bytes, available_targets: List[str]) -> str:
+        """
+        Choose the internet node for a message (see `GatewayRouter`).
+        All chunks of a transit window are sent to the same node, so it can reassemble the whole window.
+        """
+        window = transit_window(split_sequence(message)[2])
+        target = self.transit_routes.get(window)
+        if target not in available_targets:
+            target = self.router.choose(available_targets)
+        if window is not None:
+            self.transit_routes.pop(window, None)
+            self.transit_routes[window] = target
+            if len(self.transit_routes) > XBEE_TRANSIT_ROUTES:
+                del self.transit_routes[next(iter(self.transit_routes))]
+        return target
+
+    def _receive_messages(self, timeout: float = 0):
+        """
+        Move the enqueued messages into the backlogs and the beacon events into `beacons`, dropping the oldest events
+        when there are too many. Blocks for up to `timeout` seconds until the first count or transit message arrives.
+        """
+        try:
+            while True:
+                event = self.beacon_queue.get_nowait()
+                if len(self.beacons) >= XBEE_BEACON_QUEUE_SIZE:
+                    self.beacons.popleft()
+                    self.dropped_beacons += 1
+                    logger.warn(f"xbee beacon queue full. Dropping old data ({self.dropped_beacons} events dropped)")
+                self.beacons.append(event)
+        except Empty:
+            pass
 
-        # end while
+        try:
+            message = self.message_queue.get(timeout=timeout) if timeout > 0 else self.message_queue.get_nowait()
+            while True:
+                self._add_message(message)
+                message = self.message_queue.get_nowait()
+        except Empty:
+            pass
+
+    def _add_message(self, message: bytes):
+        if is_transit_message(message):
+            self.transit_backlog.add(message)
+        else:
+            self.backlog.add(message)
+
+    def _next_message(self, timeout: float) -> Union[bytes, str]:
+        """
+        Return the next message to send: transit chunks (newest window first) before count summaries (newest first,
+        packed as batch), with a batch of beacon events after every XBEE_BEACON_INTERLEAVE of them, so the events
+        do not wait until the backlogs are empty. The transit backlog is small, so it delays the counts only shortly.
+        Blocks for up to `timeout` seconds if nothing is queued. Returns None if there is nothing to send.
+        """
+        idle = len(self.backlog) == 0 and len(self.transit_backlog) == 0 and len(self.beacons) == 0
+        self._receive_messages(timeout if idle else 0)
+
+        waiting = len(self.backlog) > 0 or len(self.transit_backlog) > 0
+        if self.beacons and (not waiting or self.streak >= XBEE_BEACON_INTERLEAVE):
+            message = self._collect_beacon_batch()
+            self.streak = 0
+        elif len(self.transit_backlog) > 0:
+            message = self.transit_backlog.pop()
+            self.streak += 1
+        elif len(self.backlog) > 0:
+            message = self.backlog.pop_batch(XBEE_MAX_MESSAGE_SIZE)
+            self.streak += 1
+        else:
+            return None
+
+        # the message keeps its sequence number when it is sent again
+        self.sequence = (self.sequence + 1) % 2**16
+        return add_sequence(message, self.session, self.sequence)
+
+    def _on_data_received(self, xbee_message):
+        """remove the sequence header and drop messages that were received already"""
+        sender = xbee_message.remote_device
+        session, sequence, data = split_sequence(bytes(xbee_message.data))
+
+        if session is not None:
+            address = str(sender.get_64bit_addr())
+            last_session, received = self.received_sequences.get(address, (None, None))
+            if last_session != session:
+                # the sender restarted
+                received = deque(maxlen=XBEE_DEDUP_WINDOW)
+                self.received_sequences[address] = (session, received)
+            elif sequence in received:
+                logger.debug(f"dropping duplicate xbee message {sequence} from {sender}")
+                return
+            received.append(sequence)
+
+        self.message_received_callback(sender, data)
+
+    def set_message_received_callback(self, callback: lambda sender, data: None):
+        self.message_received_callback = callback
         
-        logger.debug("stopping xbee. Clearing queue")
-        if len(available_targets) > 0:
-            # first still selected message. Otherwhise the task is never marked done and the process stucks
-            if message:
-                self._send_message(message, timeout=0.5)
+    def enqueue_message(self, message: bytes):
+        """
+        The xbee process moves the message into its backlog right away, which keeps it bounded (see `CountBacklog`).
+        Only if the xbee process does not read the queue anymore, the message is dropped when the queue is full.
+        """
+        self._enqueue(self.message_queue, message)
 
-            while self.message_queue.qsize() > 0:
-                target = available_targets[0]
-                message = self.message_queue.get()
-                self._send_message(target, message)
+    def enqueue_beacon_message(self, encoded_event: str):
+        """the xbee process moves the event out of the queue right away and drops the oldest ones (see `_receive_messages`)"""
+        self._enqueue(self.beacon_queue, encoded_event)
 
-        logger.debug("xbee process finished")
+    def _enqueue(self, queue: mp.Queue, message: Union[bytes, str]):
+        try:
+            queue.put_nowait(message)
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+            logger.warn(f"xbee queue full, the xbee process does not read it. Dropping new data ({self.dropped.value} dropped)")
 
+    def _collect_beacon_batch(self) -> str:
+        """
+        Pack as many queued beacon events as fit into a single frame, oldest first.
+        An event that does not fit anymore is kept for the next batch.
+        """
+        events = []
+        size = len(BEACON_MESSAGE_PREFIX)
+
+        while self.beacons:
+            event = self.beacons[0]
+            added_size = len(event) + (len(BEACON_EVENT_SEPARATOR) if events else 0)
+            if events and size + added_size > XBEE_MAX_MESSAGE_SIZE:
+                break
+            events.append(self.beacons.popleft())
+            size += added_size
+
+        logger.debug(f"packed {len(events)} beacon events into one xbee message")
+        return encode_beacon_batch(events)
+
+    def _start_discovery(self, timeout: float):
+        """start the background discovery for the current device"""
+        self.discovery_wanted = threading.Event()
+        self.discovery_stop = threading.Event()
+        self.discovery_error = None
+        self.targets.clear()
+        self.discovery_thread = threading.Thread(target=self._run_discovery, args=(timeout,), name="xbee-discovery", daemon=True)
+        self.discovery_thread.start()
 
+    def _stop_discovery(self):
+        if self.discovery_thread is None:
+            return
+        self.discovery_stop.set()
+        self.discovery_wanted.set()
+        self.discovery_thread.join()
+        self.discovery_thread = None
 
-    def set_message_received_callback(self, callback: lambda sender, text: None):
-        self.message_received_callback = callback
-        
-    def enqueue_message(self, message: str):
-        if self.message_queue.qsize() >= XBEE_QUEUE_SIZE:
-            logger.warn("xbee queue full. Dropping old data")
-            self.message_queue.get()
-        self.message_queue.put(message)
-        
-        logger.debug(f"adding message to xbee queue. size: {self.message_queue.qsize()}")
+    def _check_discovery(self):
+        """raise the error of the background discovery, so the xbee process restarts"""
+        if self.discovery_error is not None:
+            raise self.discovery_error
+
+    def _run_discovery(self, timeout: float):
+        """
+        Keep `self.targets` up to date.
+        Discovered nodes are kept (last known good) and refreshed every `XBEE_DISCOVERY_TTL` seconds,
+        or earlier (but not more often than every `XBEE_DISCOVERY_INTERVAL` seconds) when a target is invalidated.
+        So sending never waits for a discovery as long as a known node is reachable.
+        """
+        while not self.discovery_stop.is_set() and not self.stop_event.is_set():
+            try:
+                available = self._discover_network(timeout)
+                logger.debug(f"available internet nodes: {available}")
+            except Exception as e:
+                logger.error(f"xbee discovery failed: {e}")
+                self.discovery_error = e
+                return
+
+            self.discovery_stop.wait(XBEE_DISCOVERY_INTERVAL)
+            if len(self._get_available_targets()) > 0:
+                self.discovery_wanted.wait(XBEE_DISCOVERY_TTL - XBEE_DISCOVERY_INTERVAL)
+            self.discovery_wanted.clear()
+
+    def _invalidate_target(self, target: str):
+        """forget a target after a failed transmission and discover again"""
+        logger.debug(f"xbee target {target} not reachable, discovering again")
+        self.targets.pop(target, None)
+        self.timeouts.pop(target, None)
+        self.discovery_wanted.set()
+
+    def _get_available_targets(self) -> List[str]:
+        """internet nodes that are known to be reachable, in the configured order"""
+        return [id for id in self.target_ids if id in self.targets]
 
     def _discover_network(self, timeout=10) -> List[str]:
         """
         Make a discovery in the xbee network with the given timeout.
-        Every discovered node is written to the self.targets dict.
+        Every discovered node is written to the self.targets dict. Nodes that were not found are kept.
 
         @return a list of the intersection between all discovered devices and set targets.
             This directly displays a list of available targets found.
@@ -254,7 +961,7 @@ class XBeeController:
         xnet.start_discovery_process(True, 1)
 
         while xnet.is_discovery_running():
-            if not self.running:
+            if self.stop_event.is_set() or self.discovery_stop.is_set():
                 xnet.stop_discovery_process()
             time.sleep(.5)
 
@@ -262,14 +969,18 @@ class XBeeController:
         logger.debug(f"found nodes: [{','.join(map(str, nodes))}]")
 
         discovered_ids = [node.get_node_id() for node in nodes]
-        
-        self.targets.clear()
+
         self.targets.update({node.get_node_id(): node for node in nodes })
 
         return [id for id in self.target_ids if id in discovered_ids]
 
 
-    def _send_message(self, target: str, message: str) -> bool:
+    def _send_message(self, target: str, message: Union[bytes, str]) -> bool:
+        """
+        Send a message to the given target and return true if it was acknowledged.
+        The target is forgotten (see `_invalidate_target`) if the transmission failed,
+        or if the acknowledgement was lost `XBEE_TIMEOUT_LIMIT` times in a row.
+        """
         remote = self.targets.get(target, None)
 
         if remote is None:
@@ -280,18 +991,28 @@ class XBeeController:
             self.device.send_data(remote, message)
         except TransmitException:
             logger.error(f"Transmit exception when sending to {target}")
+            self._invalidate_target(target)
             return False
         except TimeoutException:
             logger.error(f"TimeoutException sending to {target}")
+            # the message may have been delivered, only the acknowledgement is missing
+            self.timeouts[target] = self.timeouts.get(target, 0) + 1
+            if self.timeouts[target] >= XBEE_TIMEOUT_LIMIT:
+                self._invalidate_target(target)
             return False
 
+        self.timeouts.pop(target, None)
         logger.debug(f"Message sent to {target}")
         return True
     
     def _set_state(self, state: LEDState, value: bool):
         if self.led_communicator is None:
             return
-        
+
+        # only talk to the led process if something changed
+        if self.led_states.get(state) == value:
+            return
+        self.led_states[state] = value
         self.led_communicator.set_state(state, value)
     
 
@@ -300,6 +1021,29 @@ class XBeeStorage:
     def __init__(self, com):
         self.com = com
 
+    def save_beacon_enter(self, id: int, time: datetime, rssi: int, manufacturer_data: Dict):
+        if Config.XBee.forward_beacon:
+            event = prepare_beacon_event(id, time, BEACON_EVENT_ENTER, 0, rssi, manufacturer_data)
+            self.com.enqueue_beacon_message(encode_beacon_event(event))
+
+    def save_beacon_stay(self, id: int, time: datetime, staying_time: int, rssi_list: List, manufacturer_data: Dict):
+        if Config.XBee.forward_beacon:
+            event = prepare_beacon_event(id, time, BEACON_EVENT_EXIT, staying_time, mean(rssi_list), manufacturer_data)
+            self.com.enqueue_beacon_message(encode_beacon_event(event))
+
+    def save_beacon_scan(self, id, time, beacons):
+        # single scans are only stored locally
+        pass
+
+    def save_transit(self, id: int, timestamp: str, close_ble_list: Tuple[int], seen: Dict = None):
+        """
+        Forward the close codes to the coordinator, split into as many messages as needed.
+        The times and rssi (`seen`) are not sent over xbee.
+        """
+        if Config.XBee.forward_transit:
+            for chunk in encode_transit(id, timestamp, close_ble_list, XBEE_MAX_MESSAGE_SIZE):
+                self.com.enqueue_message(chunk)
+
     
     def save_count(self, id: int, timestamp: datetime, scans: int, scantime: float, rssi_list: List, instantaneous_counts: List, static_list: List):
 
@@ -0,0 +1,165 @@
+"""
+Minimal local stand-in for the upload endpoints of the blescan-backend.
+Used to test the internet uploads (single messages and batches) without the real backend.
+
+Every POST is accepted on any path. The body can be a single json object or a json list of objects,
+or a gzip compressed payload in the compact format (see `CompactEncoder` in blescan/network.py),
+which is expanded into the original messages again.
+GET /stats returns the number of requests, messages and bytes received per path and the number of connections.
+
+usage: python etc/mock_backend.py [port] [failure rate (0-1)] [compact (0/1)] [latency in seconds]
+e.g. set url = localhost:5000/status/update in the config and run `python etc/mock_backend.py 5000`
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import defaultdict
+import base64
+import gzip
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+DEFAULT_PORT = 5000
+
+class MockBackend(ThreadingHTTPServer):
+
+    def __init__(self, port: int = DEFAULT_PORT, failure_rate: float = 0, compact: bool = True, latency: float = 0):
+        """
+        compact -- accept the compact format, otherwise it is rejected like an older backend would
+
+        latency -- delay of every response in seconds, e.g. to simulate a mobile connection
+        """
+        super().__init__(('', port), MockBackendHandler)
+        self.failure_rate = failure_rate
+        self.compact = compact
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.messages = defaultdict(list)
+        self.bytes = defaultdict(int)
+        # (path, id) -> static fields of the compact format
+        self.static = {}
+        self.connections = 0
+
+    def record(self, path: str, messages: list, size: int):
+        with self.lock:
+            self.requests[path] += 1
+            self.messages[path].extend(messages)
+            self.bytes[path] += size
+
+    def expand(self, path: str, payload: dict) -> list:
+        """turn a compact payload into the original messages (without date and time)"""
+        with self.lock:
+            self.static.update({(path, id): fields for id, fields in payload.get('static', {}).items()})
+            static = {id: fields for (static_path, id), fields in self.static.items() if static_path == path}
+
+        messages = []
+        for row in payload['rows']:
+            message = {field: value for field, value in zip(payload['fields'], row) if value is not None}
+            for field, value in static.get(str(message.get('id')), {}).items():
+                message.setdefault(field, value)
+            if 'codes' in message:
+                message['close_ble_list'] = decode_delta_varints(base64.b64decode(message.pop('codes')))
+            messages.append(message)
+        return messages
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = {path: {'requests': self.requests[path], 'messages': len(self.messages[path]), 'bytes': self.bytes[path]}
+                     for path in self.requests}
+            stats['connections'] = self.connections
+            return stats
+
+    def start_background(self) -> threading.Thread:
+        """serve in a daemon thread, e.g. when used from a test script"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def decode_delta_varints(data: bytes) -> list:
+    """same as `util.decode_delta_varints`, so the mock backend does not depend on blescan"""
+    values = []
+    value = shift = previous = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            previous += value // 2 if value % 2 == 0 else -(value + 1) // 2
+            values.append(previous)
+            value = shift = 0
+    return values
+
+
+class MockBackendHandler(BaseHTTPRequestHandler):
+    # keep connections alive like a real server
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid waiting for the delayed ack in between
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.record_connection()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.failure_rate:
+            self._respond(503, {'error': 'simulated failure'})
+            return
+
+        compressed = self.headers.get('Content-Encoding') == 'gzip'
+        if compressed and not self.server.compact:
+            self._respond(415, {'error': 'unsupported content encoding'})
+            return
+
+        try:
+            data = json.loads(gzip.decompress(body) if compressed else body)
+        except (OSError, ValueError):
+            self._respond(400, {'error': 'invalid json'})
+            return
+
+        if isinstance(data, dict) and data.get('format') == 'compact-1':
+            messages = self.server.expand(self.path, data)
+        else:
+            messages = data if isinstance(data, list) else [data]
+        self.server.record(self.path, messages, len(body))
+        logging.info("%s: %d messages", self.path, len(messages))
+        self._respond(200, {'received': len(messages)})
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._respond(200, self.server.get_stats())
+        else:
+            self._respond(404, {})
+
+    def _respond(self, code: int, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    failure_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    compact = bool(int(sys.argv[3])) if len(sys.argv) > 3 else True
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+    logging.info("mock backend listening on port %d (failure rate %.2f, compact %s, latency %.2fs)", port, failure_rate, compact, latency)
+    MockBackend(port, failure_rate, compact, latency).serve_forever()
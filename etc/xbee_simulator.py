@@ -0,0 +1,333 @@
+"""
+Simulated XBee devices, to test and benchmark the zigbee part of blescan (XBeeController, encoding, routing) without radios.
+
+A `SimulatedNetwork` stands for the radio channel. Every `SimulatedXBeeDevice` joins it and implements the part of
+the `digi.xbee.devices.XBeeDevice` api used by `XBeeController` (open, send_data, get_network with discovery,
+data received callbacks). The network simulates latency, lost frames, lost acknowledgements (the frame arrives,
+but the sender gets a TimeoutException), the maximum payload and the airtime of the shared channel.
+Nodes can be switched off to simulate a failing internet node.
+
+Several nodes form a mesh in one process, when the controllers are started as threads:
+
+    network = SimulatedNetwork(latency=0.02, loss=0.05)
+    controller = XBeeController('simulated', device_factory=network.device_factory(), label='01')
+    controller.start(as_thread=True)
+
+usage: python etc/xbee_simulator.py [senders] [internet nodes] [seconds] [loss (0-1)]
+runs a mesh of senders forwarding count summaries to the internet nodes and prints the throughput.
+Exits with 1 if not all summaries arrived, so it can be used as a check (e.g. in CI).
+"""
+from collections import defaultdict
+from datetime import datetime
+from queue import Queue, Empty
+from typing import Callable, Dict, List
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from digi.xbee.exception import TransmitException, TimeoutException, XBeeException
+
+# frame overhead on air (mac, network and aps headers) in bytes
+SIMULATED_FRAME_OVERHEAD = 30
+# 2.4 GHz zigbee
+SIMULATED_BITRATE = 250000
+SIMULATED_MAX_PAYLOAD = 84
+# seconds the simulation waits for outstanding summaries before stopping the nodes
+SIMULATED_DELIVERY_TIMEOUT = 10
+
+
+class SimulatedNetwork:
+
+    def __init__(self, latency: float = 0.01, jitter: float = 0, loss: float = 0, ack_loss: float = 0,
+                 max_payload: int = SIMULATED_MAX_PAYLOAD, discovery_time: float = 0.2, ack_timeout: float = 0.5):
+        """
+        Keyword arguments:
+        latency -- one way delay of a frame in seconds. Sending waits for the acknowledgement (twice the latency)
+
+        jitter -- random additional delay (0 to jitter seconds)
+
+        loss -- probability that a frame is lost (TransmitException after the ack timeout)
+
+        ack_loss -- probability that the acknowledgement is lost (the frame is delivered, but TimeoutException is raised)
+
+        max_payload -- larger messages are rejected (TransmitException)
+
+        discovery_time -- duration of a discovery (instead of the configured timeout, to keep tests short)
+
+        ack_timeout -- time until a lost frame or acknowledgement is noticed
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.ack_loss = ack_loss
+        self.max_payload = max_payload
+        self.discovery_time = discovery_time
+        self.ack_timeout = ack_timeout
+        self.devices: Dict[str, 'SimulatedXBeeDevice'] = {}
+        # only one frame can be on air at the same time
+        self.channel = threading.Lock()
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def device_factory(self) -> Callable[[str, int], 'SimulatedXBeeDevice']:
+        """factory for `XBeeController(device_factory=...)`, port and baud rate are ignored"""
+        return lambda port, baud_rate: SimulatedXBeeDevice(self)
+
+    def join(self, device: 'SimulatedXBeeDevice'):
+        with self.lock:
+            self.devices[device.address] = device
+
+    def leave(self, device: 'SimulatedXBeeDevice'):
+        with self.lock:
+            self.devices.pop(device.address, None)
+
+    def find(self, pan_id: bytes, exclude: 'SimulatedXBeeDevice') -> List['SimulatedXBeeDevice']:
+        with self.lock:
+            return [device for device in self.devices.values()
+                    if device is not exclude and device.powered and device.pan_id == pan_id]
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.stats)
+
+    def _delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def transmit(self, sender: 'SimulatedXBeeDevice', address: str, data: bytes):
+        """transmit a frame and wait for the acknowledgement, like `XBeeDevice.send_data`"""
+        if len(data) > self.max_payload:
+            self.count('rejected')
+            raise TransmitException(f"payload too large ({len(data)} > {self.max_payload} bytes)")
+
+        with self.channel:
+            time.sleep((len(data) + SIMULATED_FRAME_OVERHEAD) * 8 / SIMULATED_BITRATE)
+        self.count('frames')
+        self.count('bytes', len(data))
+
+        receiver = self.devices.get(address)
+        if receiver is None or not receiver.powered or random.random() < self.loss:
+            self.count('lost')
+            time.sleep(self.ack_timeout)
+            raise TransmitException(f"no acknowledgement from {address}")
+
+        delay = self._delay()
+        receiver.deliver(SimulatedMessage(SimulatedRemoteDevice(sender), data), delay)
+        self.count('delivered')
+
+        if random.random() < self.ack_loss:
+            self.count('ack_lost')
+            time.sleep(self.ack_timeout)
+            raise TimeoutException(f"acknowledgement from {address} lost")
+        time.sleep(delay + self._delay())
+
+
+class SimulatedRemoteDevice:
+    """a node as seen from another node (like `digi.xbee.devices.RemoteXBeeDevice`)"""
+
+    def __init__(self, device: 'SimulatedXBeeDevice'):
+        self.address = device.address
+        self.node_id = device.node_id
+
+    def get_node_id(self) -> str:
+        return self.node_id
+
+    def get_64bit_addr(self) -> str:
+        return self.address
+
+    def __str__(self):
+        return f"{self.address} - {self.node_id}"
+
+
+class SimulatedMessage:
+    """received data (like `digi.xbee.models.message.XBeeMessage`)"""
+
+    def __init__(self, remote_device: SimulatedRemoteDevice, data: bytes):
+        self.remote_device = remote_device
+        self.data = bytearray(data)
+        self.timestamp = time.time()
+
+
+class SimulatedXBeeNetwork:
+    """discovery (like `digi.xbee.devices.XBeeNetwork`)"""
+
+    def __init__(self, device: 'SimulatedXBeeDevice'):
+        self.device = device
+        self.discovery_end: float = 0
+        self.devices: List[SimulatedRemoteDevice] = []
+
+    def set_discovery_timeout(self, timeout: float):
+        pass
+
+    def start_discovery_process(self, deep: bool = False, n_deep_scans: int = 1):
+        self.device.network.count('discoveries')
+        self.discovery_end = time.monotonic() + self.device.network.discovery_time
+
+    def is_discovery_running(self) -> bool:
+        running = time.monotonic() < self.discovery_end
+        if not running:
+            self.devices = [SimulatedRemoteDevice(device) for device in self.device.network.find(self.device.pan_id, self.device)]
+        return running
+
+    def stop_discovery_process(self):
+        self.discovery_end = 0
+
+    def get_devices(self) -> List[SimulatedRemoteDevice]:
+        return list(self.devices)
+
+
+class SimulatedXBeeDevice:
+    """
+    A simulated local xbee device.
+    Received messages are passed to the callbacks by a thread of the device, like the digi library does.
+    """
+
+    def __init__(self, network: SimulatedNetwork):
+        self.network = network
+        self.address = f"0013A200{random.getrandbits(32):08X}"
+        self.node_id = ' '
+        self.pan_id = b''
+        self.parameters = {}
+        self.powered = True
+        self.opened = False
+        self.callbacks = []
+        self.inbox = Queue()
+        self.xnet = SimulatedXBeeNetwork(self)
+
+    def open(self):
+        self.opened = True
+        self.network.join(self)
+        threading.Thread(target=self._receive, name=f"simulated-xbee-{self.address}", daemon=True).start()
+
+    def close(self):
+        self.opened = False
+        self.network.leave(self)
+
+    def is_open(self) -> bool:
+        return self.opened
+
+    def set_power(self, powered: bool):
+        """a device without power does not receive, send or show up in discoveries"""
+        self.powered = powered
+
+    def set_pan_id(self, pan_id: bytes):
+        self.pan_id = bytes(pan_id)
+
+    def get_pan_id(self) -> bytes:
+        return self.pan_id
+
+    def set_node_id(self, node_id: str):
+        self.node_id = node_id
+
+    def get_node_id(self) -> str:
+        return self.node_id
+
+    def set_parameter(self, parameter: str, value: bytes):
+        self.parameters[parameter] = value
+
+    def get_parameter(self, parameter: str) -> bytes:
+        return self.parameters.get(parameter, b'')
+
+    def apply_changes(self):
+        pass
+
+    def write_changes(self):
+        pass
+
+    def get_protocol(self) -> str:
+        return "simulated zigbee"
+
+    def get_network(self) -> SimulatedXBeeNetwork:
+        return self.xnet
+
+    def add_data_received_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def send_data(self, remote: SimulatedRemoteDevice, data):
+        if not self.opened or not self.powered:
+            raise XBeeException("device not open")
+        if isinstance(data, str):
+            data = data.encode()
+        self.network.transmit(self, remote.get_64bit_addr(), bytes(data))
+
+    def deliver(self, message: SimulatedMessage, delay: float):
+        self.inbox.put((time.monotonic() + delay, message))
+
+    def _receive(self):
+        while self.opened:
+            try:
+                due, message = self.inbox.get(timeout=0.5)
+            except Empty:
+                continue
+            time.sleep(max(0, due - time.monotonic()))
+            if not self.powered:
+                continue
+            for callback in self.callbacks:
+                callback(message)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'blescan'))
+    # config and storage import each other, storage has to be imported first (like main.py does through its imports)
+    import storage
+    from config import Config
+    from xbee import XBeeController, encode_data, decode_counts
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    senders = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    internet_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    loss = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+    Config.XBee.internet_ids = [f"G{i}" for i in range(internet_nodes)]
+    network = SimulatedNetwork(latency=0.02, jitter=0.01, loss=loss, ack_loss=loss / 2)
+
+    received = defaultdict(int)
+    unique = set()
+    def on_message(sender, data):
+        summaries = decode_counts(data)
+        received[sender.get_node_id()] += len(summaries)
+        unique.update((summary['id'], summary['timestamp']) for summary in summaries)
+
+    gateways = [XBeeController('simulated', device_factory=network.device_factory(), label=id) for id in Config.XBee.internet_ids]
+    nodes = [XBeeController('simulated', device_factory=network.device_factory(), label=f"N{i}") for i in range(senders)]
+    for controller in gateways:
+        controller.set_message_received_callback(on_message)
+    for controller in gateways + nodes:
+        controller.start(as_thread=True)
+
+    # every node produces a summary per second
+    summary = {'id': 0, 'timestamp': '', 'scans': 8, 'scantime': 8.0, 'tot_all': 20, 'tot_close': 10, 'inst_all': 10.0,
+               'inst_close': 5.0, 'stat_all': 2, 'stat_close': 1, 'rssi_avg': -80.0, 'rssi_std': 5.0, 'rssi_min': -95,
+               'rssi_max': -60, 'rssi_thresh': -70, 'static_ratio': 0.7, 'latitude': None, 'longitude': None}
+    produced = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        timestamp = datetime.now().replace(microsecond=0).isoformat(' ')
+        for i, controller in enumerate(nodes):
+            controller.enqueue_message(encode_data(dict(summary, id=i, timestamp=timestamp)))
+            produced += 1
+        time.sleep(1)
+
+    # give the mesh time to deliver the last summaries (and retry lost frames) before stopping
+    deadline = time.monotonic() + SIMULATED_DELIVERY_TIMEOUT
+    while len(unique) < produced and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    for controller in nodes + gateways:
+        controller.stop()
+
+    elapsed = time.monotonic() - start
+    total = sum(received.values())
+    logging.info("produced %d summaries, received %d (%.1f/s, %d duplicates) in %.1fs",
+                 produced, total, total / elapsed, total - len(unique), elapsed)
+    logging.info("received per node: %s", dict(received))
+    logging.info("network: %s", network.get_stats())
+    sys.exit(0 if len(unique) == produced else 1)
@@ -0,0 +1,85 @@
+"""
+Tests of the queues of a sender node (see `CountBacklog` and `TransitBacklog` in blescan/xbee.py).
+Needs digi-xbee and pyserial, run with `python -m unittest discover -s tests`.
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'blescan'))
+# config and storage import each other, storage has to be imported first
+import storage
+from xbee import (XBeeController, encode_data, encode_transit, decode_counts, split_sequence, is_transit_message,
+                  transit_window, XBEE_MAX_MESSAGE_SIZE, XBEE_MAX_PAYLOAD, XBEE_QUEUE_SIZE, XBEE_TRANSIT_QUEUE_SIZE)
+
+SUMMARY = {'id': 3, 'scans': 10, 'scantime': 10.0, 'tot_all': 20, 'tot_close': 10, 'inst_all': 10.0, 'inst_close': 5.0,
+           'stat_all': 2, 'stat_close': 1, 'rssi_avg': -80.0, 'rssi_std': 5.0, 'rssi_min': -95, 'rssi_max': -60,
+           'rssi_thresh': -70, 'static_ratio': 0.7, 'latitude': None, 'longitude': None}
+
+
+class BacklogTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.controller = XBeeController('test', None)
+        self.start = datetime(2026, 10, 19)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def enqueue_outage(self, hours: int):
+        """one count window and two transit windows every 10 s, like a node during an outage of the mesh"""
+        for i in range(hours * 360):
+            timestamp = self.start + timedelta(seconds=10 * i)
+            self.controller._add_message(encode_data(dict(SUMMARY, timestamp=timestamp.isoformat(' '))))
+            for offset in (0, 5):
+                window = (timestamp + timedelta(seconds=offset)).isoformat(' ')
+                for chunk in encode_transit(3, window, [1, 5, 9], XBEE_MAX_MESSAGE_SIZE):
+                    self.controller._add_message(chunk)
+
+    def test_transit_chunks_do_not_block_merging(self):
+        self.enqueue_outage(8)
+        backlog = self.controller.backlog
+
+        self.assertLessEqual(len(backlog), XBEE_QUEUE_SIZE)
+        self.assertEqual(backlog.dropped, 0)
+        windows = Counter(windows for _, windows, _ in backlog.entries)
+        self.assertEqual(sum(size * amount for size, amount in windows.items()), 8 * 360)
+        # 10 s, 60 s and 6 min windows are kept
+        self.assertTrue({1, 6, 36} <= set(windows))
+        self.assertEqual(backlog.entries[-1][1], 1)
+
+        transit = self.controller.transit_backlog
+        self.assertLessEqual(len(transit), XBEE_TRANSIT_QUEUE_SIZE)
+        newest = self.start + timedelta(seconds=10 * (8 * 360 - 1) + 5)
+        self.assertEqual(transit_window(transit.chunks[-1]), (3, int(newest.timestamp())))
+
+    def test_messages_are_sent_newest_first(self):
+        self.enqueue_outage(1)
+
+        kinds = []
+        counts = []
+        message = self.controller._next_message(0)
+        while message is not None:
+            self.assertLessEqual(len(message), XBEE_MAX_PAYLOAD)
+            data = split_sequence(message)[2]
+            if is_transit_message(data):
+                kinds.append('transit')
+            else:
+                kinds.append('count')
+                counts.extend(decode_counts(data))
+            message = self.controller._next_message(0)
+
+        # the transit chunks that were kept first, then all count windows
+        self.assertEqual(kinds, ['transit'] * XBEE_TRANSIT_QUEUE_SIZE + ['count'] * kinds.count('count'))
+        self.assertEqual(len(counts), 360)
+        # the first batch has the two newest windows
+        timestamps = [count['timestamp'] for count in counts]
+        self.assertEqual(set(timestamps[:2]), set(sorted(timestamps)[-2:]))
+
+
+if __name__ == '__main__':
+    unittest.main()